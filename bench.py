@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+"""
+Headless benchmark of the UI. Feeds SimpleUI with synthetic samples from FakeSensor/FakeAirtime at the
+amount the sensor delivers between two frames and reports the time spent in the stages of a frame.
+With the queue transport, update_data also pays for the pickling in the feeder thread of the queue.
+
+    $ python3 bench.py [--frames N] [--fps FPS] [--transport queue|shm] [--detector] [scenario ...]
+    $ python3 bench.py --channel-power N
+    $ python3 bench.py --sensors N [--transport queue|shm]
+
+With --sensors, 1 .. N synthetic sensors run in worker processes of a MultiSensor, each as fast as its decoder
+keeps up with, and the samples/s that arrive at the UI side are reported in total and per sensor.
+"""
+
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")  # no display needed
+
+import sys
+import math
+import time
+import logging
+import argparse
+import multiprocessing as mp
+from ui import SimpleUI
+from functools import partial
+from fakesensor import FakeSensor, FakeAirtime, FakePipeline, CHANNELS_24, CHANNELS_5
+from multisensor import MultiSensor
+from metrics import Metrics
+from detector import BurstDetector, EventLog
+from transport import (QueueReader, SpectralRingBuffer, AirtimeRingBuffer, pack_spectral, pack_airtime,
+                       channel_power)
+
+# name: (sensor mode, HT mode, view)
+scenarios = {
+    "chanscan-ht20": ("chanscan", "HT20", SimpleUI.view_cs),
+    "chanscan-ht40": ("chanscan", "HT40", SimpleUI.view_cs),
+    "background-ht20": ("background", "HT20", SimpleUI.view_bg),
+    "background-ht40": ("background", "HT40", SimpleUI.view_bg),
+    "heatmap-ht20": ("background", "HT20", SimpleUI.view_hm),
+    "heatmap-ht40": ("background", "HT40", SimpleUI.view_hm),
+}
+
+
+class CountingSource(object):
+    # counts the records the UI actually took from a source
+
+    def __init__(self, source):
+        self.source = source
+        self.count = 0
+
+    def read(self):
+        records = self.source.read()
+        self.count += len(records)
+        return records
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+
+def run(name, frames, fps, transport, detector=False):
+    mode, ht_mode, view = scenarios[name]
+    sensor = FakeSensor(seed=1)
+    sensor.set_mode(mode)
+    sensor.set_HT_mode(ht_mode)
+    airtime = FakeAirtime(sensor, seed=2)
+    frame_us = int(1e6 / fps)
+    data = []
+    for i in range(frames):
+        data.append((sensor.generate(frame_us), airtime.generate()))
+
+    if transport == "shm":
+        ath_queue, airtime_queue = SpectralRingBuffer(), AirtimeRingBuffer()
+        ath_source, airtime_source = CountingSource(ath_queue), CountingSource(airtime_queue)
+    else:
+        ath_queue, airtime_queue = mp.Queue(), mp.Queue()
+        ath_source = CountingSource(QueueReader(ath_queue, pack_spectral))
+        airtime_source = CountingSource(QueueReader(airtime_queue, pack_airtime))
+    ui = SimpleUI(athscanner=sensor, ath_queue_in=ath_source, airtime_queue_in=airtime_source)
+    ui.current_view = view
+    if detector:
+        ui.detector = BurstDetector(EventLog())
+
+    t_update = 0.0
+    t_draw = 0.0
+    expected = 0
+    for samples, frames_air in data:
+        for item in samples:
+            ath_queue.put(item)
+        for item in frames_air:
+            airtime_queue.put(item)
+        expected += len(samples) + len(frames_air)
+
+        t0 = time.perf_counter()
+        # a mp.Queue hands the items over to the pipe in a feeder thread, so they may trickle in
+        while ath_source.count + airtime_source.count < expected:
+            ui.update_data()
+        t1 = time.perf_counter()
+        if ui.clean_screen:
+            ui.clean_screen = False
+            ui.screen.fill(ui.bg_color)
+            ui.draw_grid()
+        if view is SimpleUI.view_hm:
+            ui.data_to_screen_power()
+        else:
+            ui.data_to_screen_freq()
+        t2 = time.perf_counter()
+        t_update += t1 - t0
+        t_draw += t2 - t1
+
+    if transport == "shm":
+        ath_queue.close()
+        airtime_queue.close()
+    samples = ath_source.count + airtime_source.count
+    draw_stage = "data_to_screen_power" if view is SimpleUI.view_hm else "data_to_screen_freq"
+    rows = [
+        (name, "update_data", samples / t_update, 1000 * t_update / frames),
+        (name, draw_stage, samples / t_draw, 1000 * t_draw / frames),
+    ]
+    if detector:  # part of update_data
+        t_detect = ui.metrics.timings.get("detect", [0, 0.0, 0.0])[1]
+        rows.append((name, "detect", samples / max(t_detect, 1e-9), 1000 * t_detect / frames))
+    return rows
+
+
+def pwr_of_channel(pwr_per_subcarrier):
+    # the former per sample version in SimpleUI, as reference for channel_power()
+    rssi_sum = 0
+    for freq, pwr in pwr_per_subcarrier.items():
+        rssi_sum += 10 ** (pwr / 10)
+    if rssi_sum != 0:
+        return 10 * math.log10(rssi_sum)
+    else:
+        return -200
+
+
+def run_channel_power(ht_mode, n):
+    sensor = FakeSensor(seed=1)
+    sensor.set_HT_mode(ht_mode)
+    items = []
+    while len(items) < n:  # about the time n samples take, not more
+        items += sensor.generate(int((n - len(items)) / sensor.bg_rate * 1e6) + 1)
+    records = pack_spectral(items[:n])
+    records['n_bins'][:10] = 0  # no subcarriers at all: -200
+    t0 = time.perf_counter()
+    reference = [pwr_of_channel(dict(zip(freq[:n_bins], pwr[:n_bins])))
+                 for (freq, pwr, n_bins) in zip(records['freq'], records['pwr'], records['n_bins'])]
+    t1 = time.perf_counter()
+    chan_pwr = channel_power(records)
+    t2 = time.perf_counter()
+    diff = float(abs(chan_pwr - reference).max())
+    return ("channel-" + ht_mode.lower(), len(records) / (t1 - t0), len(records) / (t2 - t1), diff)
+
+
+def run_sensors(n, transport, seconds=5.0, bg_rate=200000):
+    factories = {"fake%d" % i: partial(FakePipeline, CHANNELS_24 if i % 2 == 0 else CHANNELS_5,
+                                       bg_rate=bg_rate, max_decoders=2, seed=i) for i in range(n)}
+    multi = MultiSensor(factories, transport)
+    metrics = Metrics(window=0)  # every tick() rolls over
+    multi.set_metrics(metrics)
+    multi.start()
+    time.sleep(1)  # let the decoders settle
+    multi.spectral.read()
+    metrics.tick()  # start counting from here
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < seconds:
+        if not len(multi.spectral.read()):
+            time.sleep(0.001)
+    metrics.tick()
+    multi.stop()
+    per_sensor = [metrics.last.get("ath_%s_per_s" % name, 0.0) for name in factories]
+    return n, sum(per_sensor), " ".join("%.0f" % rate for rate in per_sensor)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="headless UI benchmark with a synthetic sensor")
+    parser.add_argument("scenario", nargs="*", help="scenarios to run, out of %s (default: all)" % ", ".join(
+        sorted(scenarios)))
+    parser.add_argument("--frames", type=int, default=100, help="number of frames per scenario (default: 100)")
+    parser.add_argument("--fps", type=float, default=15, help="frame rate the sensor data is split into (default: 15)")
+    parser.add_argument("--transport", choices=["queue", "shm"], default="queue")
+    parser.add_argument("--channel-power", type=int, metavar="N",
+                        help="compare the channel power of N samples per sample and vectorized instead")
+    parser.add_argument("--detector", action="store_true", help="run the burst detector in update_data")
+    parser.add_argument("--sensors", type=int, metavar="N",
+                        help="measure the throughput of 1 .. N synthetic sensors in a MultiSensor instead")
+    args = parser.parse_args()
+    if args.sensors:
+        print("%-8s %12s  %s" % ("sensors", "samples/s", "per sensor"))
+        for n in range(1, args.sensors + 1):
+            print("%-8d %12.0f  %s" % run_sensors(n, args.transport))
+            sys.stdout.flush()
+        sys.exit()
+    if args.channel_power:
+        print("%-16s %16s %16s %10s" % ("samples", "per sample/s", "vectorized/s", "max diff"))
+        for ht_mode in ("HT20", "HT40"):
+            print("%-16s %16.0f %16.0f %10.1g" % run_channel_power(ht_mode, args.channel_power))
+        sys.exit()
+    for name in args.scenario:
+        if name not in scenarios:
+            parser.error("unknown scenario %s" % name)
+    logging.getLogger("ui").setLevel(logging.WARNING)
+
+    print("%-16s %-22s %12s %10s" % ("scenario", "stage", "samples/s", "ms/frame"))
+    for name in args.scenario or sorted(scenarios):
+        for row in run(name, args.frames, args.fps, args.transport, args.detector):
+            print("%-16s %-22s %12.0f %10.2f" % row)
+        sys.stdout.flush()
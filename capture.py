@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+"""
+Capture file format. A capture holds the decoded spectral and airtime records as appended chunks:
+
+    header:  MAGIC, u32 length of the JSON metadata (sensor setup, record layouts), JSON, padding to 8 byte
+    chunk:   kind (u8), padding, n_bins (u16), count (u32), tsf_first (u64), tsf_last (u64), count raw records
+
+Spectral records are stored cut to the n_bins of the chunk (see trim_spectral()), HT20 samples use 56 of the
+128 subcarriers. n_bins is 0 for records in the full layout, as in the airtime chunks and in older captures.
+
+The time index lives next to it in <capture>.idx, one index_dtype entry per chunk. Both files are only
+appended to. If the index is missing or behind (e.g. after a crash), it is rebuilt from the chunk headers.
+"""
+
+import os
+import json
+import time
+import struct
+import logging
+import numpy as np
+from transport import spectral_dtype, airtime_dtype, channel_power, trimmed_dtype, trim_spectral, untrim_spectral
+logger = logging.getLogger(__name__)
+
+MAGIC = b"ATHCAP01"
+(kind_spectral, kind_airtime) = range(2)
+chunk_header = struct.Struct("<BxHIQQ")
+index_dtype = np.dtype([
+    ('offset', '<u8'),
+    ('kind', 'u1'),
+    ('count', '<u4'),
+    ('tsf_first', '<u8'),
+    ('tsf_last', '<u8'),
+])
+
+
+def sensor_info(sensor):
+    # snapshot of the sensor setup, enough to let ReplaySensor stand in for it
+    return {
+        "freqchan": [list(fc) for fc in sensor.get_supported_freqchan()],
+        "mode": sensor.get_mode(),
+        "chan": sensor.current_chan,
+        "freq": sensor.current_freq,
+        "ht_mode": sensor.current_ht_mode,
+        "spectral_count": sensor.get_spectral_count(),
+    }
+
+
+def upgrade_records(records, dtype):
+    # copies records of an older layout into dtype, fields that are missing get their default or are derived
+    upgraded = np.zeros(len(records), dtype=dtype)
+    for name in records.dtype.names:
+        if name in dtype.names:
+            upgraded[name] = records[name]
+    if 'chan_pwr' in dtype.names and 'chan_pwr' not in records.dtype.names:
+        upgraded['chan_pwr'] = channel_power(upgraded)
+    return upgraded
+
+
+class CaptureWriter(object):
+
+    def __init__(self, path, info):
+        self.path = path
+        self.file = open(path, "wb")
+        self.index_file = open(path + ".idx", "wb")
+        meta = json.dumps({
+            "version": 2,
+            "sensor": info,
+            "dtypes": {
+                str(kind_spectral): np.lib.format.dtype_to_descr(spectral_dtype),
+                str(kind_airtime): np.lib.format.dtype_to_descr(airtime_dtype),
+            },
+        }).encode()
+        header = MAGIC + struct.pack("<I", len(meta)) + meta
+        self.file.write(header + b"\0" * (-len(header) % 8))
+        self.chunks = 0
+
+    def write(self, kind, records):
+        if not len(records):
+            return
+        tsf = records['tsf']
+        first, last = int(tsf.min()), int(tsf.max())
+        offset = self.file.tell()
+        n_bins = 0
+        if kind == kind_spectral:
+            n_bins, records = trim_spectral(records)
+        self.file.write(chunk_header.pack(kind, n_bins, len(records), first, last))
+        self.file.write(np.ascontiguousarray(records))
+        self.index_file.write(np.array([(offset, kind, len(records), first, last)], dtype=index_dtype).tobytes())
+        self.chunks += 1
+
+    def close(self):
+        self.file.close()
+        self.index_file.close()
+        logger.info("wrote %d chunks to %s" % (self.chunks, self.path))
+
+
+class CaptureReader(object):
+    """
+    Memory-mapped read access to a capture. Records in the full current layout are returned as views into the
+    mapping, trimmed spectral records and records of captures with an older layout are converted to it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mm = np.memmap(path, dtype=np.uint8, mode="r")
+        if bytes(self.mm[:len(MAGIC)]) != MAGIC:
+            raise ValueError("%s is not an athgui capture" % path)
+        (meta_len,) = struct.unpack("<I", bytes(self.mm[len(MAGIC):len(MAGIC) + 4]))
+        meta_end = len(MAGIC) + 4 + meta_len
+        meta = json.loads(bytes(self.mm[len(MAGIC) + 4:meta_end]).decode())
+        self.sensor = meta["sensor"]
+        self.file_dtypes = {int(kind): np.lib.format.descr_to_dtype(d) for kind, d in meta["dtypes"].items()}
+        self.dtypes = {kind_spectral: spectral_dtype, kind_airtime: airtime_dtype}  # of the returned records
+        self.converted = {}  # kind: (offset, records) of the last chunk converted to the current layout
+        self.data_start = meta_end + (-meta_end % 8)
+        self.index = self._load_index()
+
+    def _load_index(self):
+        index = np.zeros(0, dtype=index_dtype)
+        if os.path.exists(self.path + ".idx"):
+            index = np.fromfile(self.path + ".idx", dtype=index_dtype)
+        pos = self.data_start
+        if len(index):
+            last = index[-1]
+            itemsize = self.chunk_dtype(int(last['offset'])).itemsize
+            pos = int(last['offset']) + chunk_header.size + int(last['count']) * itemsize
+        if pos < len(self.mm):
+            logger.info("index of %s is incomplete, scanning chunks" % self.path)
+            index = np.concatenate((index, self._scan(pos)))
+        return index
+
+    def _scan(self, pos):
+        entries = []
+        while pos + chunk_header.size <= len(self.mm):
+            kind, n_bins, count, first, last = chunk_header.unpack(bytes(self.mm[pos:pos + chunk_header.size]))
+            end = pos + chunk_header.size + count * self.chunk_dtype(pos).itemsize
+            if end > len(self.mm):  # truncated chunk
+                break
+            entries.append((pos, kind, count, first, last))
+            pos = end
+        return np.array(entries, dtype=index_dtype)
+
+    def chunk_dtype(self, offset):
+        # layout of the records in the chunk at offset
+        kind, n_bins = chunk_header.unpack(bytes(self.mm[offset:offset + chunk_header.size]))[:2]
+        if n_bins:
+            return trimmed_dtype(n_bins, self.file_dtypes[kind])
+        return self.file_dtypes[kind]
+
+    @property
+    def tsf_first(self):
+        return int(self.index['tsf_first'].min()) if len(self.index) else 0
+
+    @property
+    def tsf_last(self):
+        return int(self.index['tsf_last'].max()) if len(self.index) else 0
+
+    def chunks(self, kind):
+        return self.index[self.index['kind'] == kind]
+
+    def records(self, chunk):
+        kind, count, offset = int(chunk['kind']), int(chunk['count']), int(chunk['offset'])
+        records = np.ndarray((count,), dtype=self.chunk_dtype(offset), buffer=self.mm,
+                             offset=offset + chunk_header.size)
+        if records.dtype == self.dtypes[kind]:
+            return records
+        if kind not in self.converted or self.converted[kind][0] != offset:
+            if records.dtype != self.file_dtypes[kind]:  # trimmed spectral records
+                records = untrim_spectral(records, self.file_dtypes[kind])
+            if records.dtype != self.dtypes[kind]:  # an older capture
+                records = upgrade_records(records, self.dtypes[kind])
+            self.converted[kind] = (offset, records)
+        return self.converted[kind][1]
+
+    def close(self):
+        del self.mm
+
+
+class ReplaySensor(object):
+    """
+    Stands in for the AthSpectralScanner during replay. The recorded data cannot be retuned, so all
+    controls only log a note.
+    """
+
+    def __init__(self, info):
+        self.freqchan = [tuple(fc) for fc in info["freqchan"]]
+        self.mode = info["mode"]
+        self.current_chan = info["chan"]
+        self.current_freq = info["freq"]
+        self.current_ht_mode = info["ht_mode"]
+        self.spectral_count = info["spectral_count"]
+
+    def get_supported_freqchan(self):
+        return self.freqchan
+
+    def get_mode(self):
+        return self.mode
+
+    def get_spectral_count(self):
+        return self.spectral_count
+
+    def _not_supported(self, *args):
+        logger.info("sensor controls are not available during replay")
+
+    set_mode_background = set_mode_chanscan = set_channel = set_spectral_count = set_HT_mode = _not_supported
+
+    def start(self):
+        pass
+
+
+class ReplaySource(object):
+    """
+    Delivers the records of one stream up to the current replay time, with the same interface as the
+    transports in transport.py.
+    """
+
+    def __init__(self, player, kind):
+        self.player = player
+        self.kind = kind
+        self.chunks = player.reader.chunks(kind)
+        self.empty_records = np.zeros(0, dtype=player.reader.dtypes[kind])
+        self.dropped = 0
+        self.epoch = 0  # a replay cannot be retuned, all recorded records are current
+        self.seek(player.reader.tsf_first)
+
+    def seek(self, tsf):
+        self.chunk_pos = int(np.searchsorted(self.chunks['tsf_last'], tsf, side="left"))
+        self.rec_pos = 0
+        if self.chunk_pos < len(self.chunks):
+            records = self.player.reader.records(self.chunks[self.chunk_pos])
+            self.rec_pos = int(np.count_nonzero(records['tsf'] < tsf))
+
+    def read(self):
+        now = self.player.now()
+        while self.chunk_pos < len(self.chunks):
+            records = self.player.reader.records(self.chunks[self.chunk_pos])
+            if self.rec_pos >= len(records):
+                self.chunk_pos += 1
+                self.rec_pos = 0
+                continue
+            later = np.flatnonzero(records['tsf'][self.rec_pos:] > now)
+            end = self.rec_pos + later[0] if len(later) else len(records)
+            if end == self.rec_pos:
+                break
+            batch = records[self.rec_pos:end]
+            self.rec_pos = end
+            return batch
+        self.player.idle()
+        return self.empty_records
+
+    def qsize(self):
+        pending = self.chunks[self.chunk_pos:]
+        return int(pending['count'][pending['tsf_first'] <= self.player.now()].sum()) - self.rec_pos
+
+    def set_epoch(self, epoch):
+        pass
+
+    def clear(self):
+        self.seek(self.player.now() + 1)
+
+    def done(self):
+        return self.chunk_pos >= len(self.chunks)
+
+
+class CapturePlayer(object):
+    """
+    Replays a capture paced by the recorded TSF, `speed` times faster than real time. With speed 0, the
+    replay time advances by one chunk whenever a source ran dry, i.e. as fast as the UI takes the data.
+    """
+
+    def __init__(self, reader, speed=1.0):
+        self.reader = reader
+        self.speed = speed
+        self.chunk_ends = np.sort(reader.index['tsf_last'])
+        self.tsf_origin = reader.tsf_first
+        self.t_origin = None
+        self.tsf_now = self.tsf_origin
+        self.finished = False
+        self.spectral = ReplaySource(self, kind_spectral)
+        self.airtime = ReplaySource(self, kind_airtime)
+
+    def seek(self, tsf):
+        self.tsf_origin = self.tsf_now = tsf
+        self.t_origin = None
+        self.spectral.seek(tsf)
+        self.airtime.seek(tsf)
+
+    def now(self):
+        if not self.speed:
+            return self.tsf_now
+        if self.t_origin is None:  # start the clock with the first read
+            self.t_origin = time.monotonic()
+        return self.tsf_origin + int((time.monotonic() - self.t_origin) * 1e6 * self.speed)
+
+    def idle(self):
+        if not self.speed:
+            # jump to the end of the next chunk
+            idx = np.searchsorted(self.chunk_ends, self.tsf_now, side="right")
+            if idx < len(self.chunk_ends):
+                self.tsf_now = int(self.chunk_ends[idx])
+        if not self.finished and self.spectral.done() and self.airtime.done():
+            self.finished = True
+            logger.info("replay of %s finished" % self.reader.path)
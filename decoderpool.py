@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import time
+import queue
+import logging
+import threading
+import multiprocessing as mp
+logger = logging.getLogger(__name__)
+
+
+def _worker(decode, tasks, results, stopping):
+    # runs in a decoder process until it gets the stop sentinel, chunks left when stopping are skipped
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if stopping.is_set():
+            continue
+        seq, chunk = task
+        t0 = time.perf_counter()
+        items = decode(chunk)
+        results.put((seq, items, time.perf_counter() - t0))
+
+
+class DecoderPool(object):
+    """
+    Autoscaling pool of decoder processes. Raw chunks are numbered by put(), decoded by `decode` (a
+    picklable function chunk -> list of items) in one of the worker processes, and the items are put into
+    the output queue in the order of the chunks. So the TSF order of the input is kept, no matter which
+    worker finishes first.
+
+    Every `interval` seconds the pool looks at the backlog (chunks put, but not yet delivered) and the
+    latency of the chunks (put to delivery). It adds a worker if the backlog exceeds grow_backlog chunks
+    per worker or the latency exceeds max_latency, and removes one after `cooldown` seconds without backlog.
+    """
+
+    def __init__(self, decode, output_queue=None, min_workers=1, max_workers=None, interval=1.0,
+                 grow_backlog=4, max_latency=0.2, cooldown=5.0):
+        self.decode = decode
+        self.output_queue = output_queue
+        self.set_workers(min_workers, max_workers)
+        self.interval = interval
+        self.grow_backlog = grow_backlog
+        self.max_latency = max_latency
+        self.cooldown = cooldown
+        self.tasks = mp.Queue()
+        self.results = mp.Queue()
+        self.stopping = mp.Event()
+        self.workers = []  # all started processes, retired ones are pruned by the scaler
+        self.retiring = 0  # stop sentinels queued, but not yet taken by a worker
+        self.next_seq = 0  # number of the next chunk put
+        self.delivered = 0  # number of the next chunk to deliver
+        self.put_time = {}  # seq: time of put()
+        self.latency = 0.0  # of the last interval, s
+        self.decode_time = 0.0  # mean per chunk of the last interval, s
+        self.lock = threading.Lock()
+        self.running = False
+        self.threads = []
+
+    # AthSpectralScanDecoder alike API
+    def set_output_queue(self, output_queue):
+        self.output_queue = output_queue
+
+    def set_number_of_processes(self, number):
+        # pins the pool to a fixed size
+        self.min_workers = self.max_workers = max(number, 1)
+
+    def set_workers(self, min_workers=1, max_workers=None):
+        # range the scaler works in, max_workers None: the CPU count
+        self.min_workers = max(min_workers, 1)
+        self.max_workers = max(max_workers or mp.cpu_count(), self.min_workers)
+
+    def enqueue(self, chunk):
+        # the DataHub hands the raw data over this way
+        self.put(chunk)
+
+    def start(self):
+        self.running = True
+        self.stopping.clear()
+        while len(self.workers) < self.min_workers:
+            self._grow()
+        for target, name in ((self._collect, "decoder-collect"), (self._scale, "decoder-scale")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        try:  # drop the backlog, what is still in the feeder of the queue the workers skip
+            while True:
+                self.tasks.get_nowait()
+        except queue.Empty:
+            pass
+        for worker in self.workers:
+            if worker.is_alive():
+                self.tasks.put(None)
+        for worker in self.workers:
+            # a worker does not exit before its results are flushed into the pipe, so keep reading them
+            while worker.is_alive():
+                try:
+                    self.results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            worker.join()
+        self.workers = []
+        self.retiring = 0
+
+    def put(self, chunk):
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.put_time[seq] = time.monotonic()
+        self.tasks.put((seq, chunk))
+
+    def backlog(self):
+        return self.next_seq - self.delivered
+
+    def active_workers(self):
+        return len(self.workers) - self.retiring
+
+    def _grow(self):
+        worker = mp.Process(target=_worker, args=(self.decode, self.tasks, self.results, self.stopping),
+                            daemon=True)
+        worker.start()
+        self.workers.append(worker)
+
+    def _shrink(self):
+        # whichever worker takes the sentinel exits, the others go on
+        self.retiring += 1
+        self.tasks.put(None)
+
+    def _prune(self):
+        alive = [worker for worker in self.workers if worker.is_alive()]
+        self.retiring -= len(self.workers) - len(alive)
+        self.workers = alive
+
+    def _collect(self):
+        pending = {}  # seq: items, decoded out of order
+        latencies = []
+        decode_times = []
+        window_start = time.monotonic()
+        while self.running:
+            try:
+                seq, items, decode_time = self.results.get(timeout=0.1)
+            except queue.Empty:
+                seq = None
+            if seq is not None:
+                pending[seq] = items
+                decode_times.append(decode_time)
+            while self.delivered in pending:
+                items = pending.pop(self.delivered)
+                if hasattr(self.output_queue, "put_many"):  # e.g. a SharedRingBuffer packs them in one go
+                    self.output_queue.put_many(items)
+                else:
+                    for item in items:
+                        self.output_queue.put(item)
+                with self.lock:
+                    latencies.append(time.monotonic() - self.put_time.pop(self.delivered))
+                    self.delivered += 1
+            if time.monotonic() - window_start >= self.interval:
+                self.latency = max(latencies) if latencies else 0.0
+                self.decode_time = sum(decode_times) / len(decode_times) if decode_times else 0.0
+                latencies = []
+                decode_times = []
+                window_start = time.monotonic()
+
+    def _log_scaling(self, workers, new_workers, backlog):
+        logger.info("decoder pool: %d -> %d workers (backlog %d chunks, latency %.0f ms, decode %.1f ms)" % (
+            workers, new_workers, backlog, 1000 * self.latency, 1000 * self.decode_time))
+
+    def _scale(self):
+        idle_since = time.monotonic()
+        while self.running:
+            time.sleep(self.interval)
+            self._prune()
+            backlog = self.backlog()
+            workers = self.active_workers()
+            if backlog > self.grow_backlog * workers or self.latency > self.max_latency:
+                idle_since = time.monotonic()
+                if workers < self.max_workers:
+                    self._grow()
+                    self._log_scaling(workers, workers + 1, backlog)
+            elif backlog > 1 or self.latency > self.max_latency / 4:
+                idle_since = time.monotonic()
+            elif workers > self.min_workers and time.monotonic() - idle_since > self.cooldown:
+                self._shrink()
+                idle_since = time.monotonic()
+                self._log_scaling(workers, workers - 1, backlog)
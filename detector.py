@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+"""
+Online detection of non-WiFi interference: spectral samples with a channel power well above the noise floor
+that no WiFi frame seen by the airtime calculator explains. Consecutive ones on a channel form a burst, which
+goes into an append-only event log. The log can be queried by time and frequency:
+
+    $ python3 detector.py events.log [--tsf-min TSF] [--tsf-max TSF] [--freq-min MHZ] [--freq-max MHZ]
+
+An event log file starts with MAGIC, the length of the JSON meta data (uint32 LE) and the meta data itself,
+padded to 8 bytes, followed by the bursts as records of burst_dtype.
+"""
+
+import os
+import sys
+import json
+import struct
+import logging
+import argparse
+import threading
+import numpy as np
+from transport import MAX_BINS
+logger = logging.getLogger(__name__)
+
+MAGIC = b"ATHEVT01"
+
+# one burst, freq_lo/freq_hi are the outermost subcarriers above the noise floor
+burst_dtype = np.dtype([
+    ('tsf_start', '<u8'),
+    ('tsf_end', '<u8'),
+    ('freq_cf', '<f4'),  # center frequency of the channel the sensor was on
+    ('freq_lo', '<f4'),
+    ('freq_hi', '<f4'),
+    ('pwr_peak', '<f4'),  # max channel power (dBm)
+    ('samples', '<u4'),
+])
+
+# per block of the event log, the range of TSF and frequency its bursts cover
+block_dtype = np.dtype([
+    ('tsf_min', np.uint64),
+    ('tsf_max', np.uint64),
+    ('freq_min', np.float32),
+    ('freq_max', np.float32),
+])
+
+# a spectral sample above the noise floor, waiting for the airtime data of its time
+candidate_dtype = np.dtype([
+    ('tsf', np.int64),
+    ('freq_cf', np.float32),
+    ('freq_lo', np.float32),
+    ('freq_hi', np.float32),
+    ('chan_pwr', np.float32),
+    ('sensor', np.uint8),
+])
+
+
+class EventLog(object):
+    """
+    Append-only log of bursts, in a file that is continued if it exists (or only read, with readonly), or
+    without a path in memory only.
+    Queries go through a block index: for every `block_size` bursts it holds the TSF and frequency range
+    they cover, so only the blocks that overlap the query are read back from the file. The bursts come in
+    (nearly) in time order, so the blocks of a time range are few. Only the index and the last, incomplete
+    block stay in memory, so a long run does not grow the process.
+    """
+
+    def __init__(self, path=None, block_size=1024, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.block_size = block_size
+        self.count = 0
+        self.blocks = np.zeros(0, dtype=block_dtype)
+        self.tail = np.zeros(0, dtype=burst_dtype)  # bursts of the last block, if it is incomplete
+        self.records = None  # all bursts, only without a file
+        self.file = None
+        self.reader = None
+        self.data_start = 0
+        if path is None:
+            self.records = np.zeros(block_size, dtype=burst_dtype)
+        else:
+            self._open(path)
+
+    def _open(self, path):
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, "rb") as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    raise ValueError("%s is not an event log" % path)
+                meta_len, = struct.unpack("<I", f.read(4))
+                meta = json.loads(f.read(meta_len).decode())
+                if np.lib.format.descr_to_dtype(meta["dtype"]) != burst_dtype:
+                    raise ValueError("%s has an unknown record layout" % path)
+            start = len(MAGIC) + 4 + meta_len
+            self.data_start = start + (-start % 8)
+            count = (os.path.getsize(path) - self.data_start) // burst_dtype.itemsize
+            if not self.readonly:
+                self.file = open(path, "r+b")
+                self.file.truncate(self.data_start + count * burst_dtype.itemsize)  # a torn record at the end
+                self.file.seek(0, os.SEEK_END)
+            self.reader = open(path, "rb")
+            # rebuild the index block by block
+            for first in range(0, count, self.block_size):
+                self.count = first
+                self._index(self._read(first, min(self.block_size, count - first)))
+            self.count = count
+            if not self.readonly:
+                logger.info("continuing %s with %d bursts" % (path, count))
+        else:
+            self.file = open(path, "wb")
+            meta = json.dumps({"version": 1, "dtype": np.lib.format.dtype_to_descr(burst_dtype)}).encode()
+            header = MAGIC + struct.pack("<I", len(meta)) + meta
+            self.file.write(header + b"\0" * (-len(header) % 8))
+            self.file.flush()
+            self.data_start = self.file.tell()
+            self.reader = open(path, "rb")
+
+    def __len__(self):
+        return self.count
+
+    def _read(self, first, count):
+        # bursts first .. first + count - 1
+        if self.records is not None:
+            return self.records[first:first + count]
+        self.reader.seek(self.data_start + first * burst_dtype.itemsize)
+        return np.fromfile(self.reader, dtype=burst_dtype, count=count)
+
+    def _index(self, bursts):
+        # summarizes the blocks that get the bursts appended at self.count
+        pending = np.concatenate((self.tail, bursts))
+        first_block = len(self.blocks) - (1 if len(self.tail) else 0)
+        blocks = [pending[i:i + self.block_size] for i in range(0, len(pending), self.block_size)]
+        summaries = np.array([(block['tsf_start'].min(), block['tsf_end'].max(),
+                               block['freq_lo'].min(), block['freq_hi'].max()) for block in blocks],
+                             dtype=block_dtype)
+        self.blocks = np.concatenate((self.blocks[:first_block], summaries))
+        last = blocks[-1]
+        self.tail = last.copy() if len(last) < self.block_size else pending[:0].copy()
+
+    def append(self, bursts):
+        if not len(bursts):
+            return
+        bursts = np.ascontiguousarray(bursts, dtype=burst_dtype)
+        if self.records is not None:
+            if self.count + len(bursts) > len(self.records):
+                records = np.zeros(max(2 * len(self.records), self.count + len(bursts)), dtype=burst_dtype)
+                records[:self.count] = self.records[:self.count]
+                self.records = records
+            self.records[self.count:self.count + len(bursts)] = bursts
+        if self.file is not None:
+            self.file.write(bursts.tobytes())
+            self.file.flush()
+        self._index(bursts)
+        self.count += len(bursts)
+
+    def query(self, tsf_min=0, tsf_max=2 ** 64 - 1, freq_min=-np.inf, freq_max=np.inf):
+        """
+        Returns the bursts that overlap the TSF range and the frequency range, ordered by start.
+        """
+        b = self.blocks
+        hit = np.flatnonzero((b['tsf_max'] >= tsf_min) & (b['tsf_min'] <= tsf_max) &
+                             (b['freq_max'] >= freq_min) & (b['freq_min'] <= freq_max))
+        if not len(hit):
+            return np.zeros(0, dtype=burst_dtype)
+        bs = self.block_size
+        records = np.concatenate([self._read(i * bs, min(bs, self.count - i * bs)) for i in hit])
+        records = records[(records['tsf_end'] >= tsf_min) & (records['tsf_start'] <= tsf_max) &
+                          (records['freq_hi'] >= freq_min) & (records['freq_lo'] <= freq_max)]
+        return records[np.argsort(records['tsf_start'], kind="stable")]
+
+    def close(self):
+        for f in (self.file, self.reader):
+            if f is not None:
+                f.close()
+        self.file = self.reader = None
+
+
+class BurstDetector(object):
+    """
+    Streaming detector of non-WiFi bursts, fed with the spectral records (which carry the channel power) and
+    the airtime records as they arrive.
+
+    A spectral sample is hot if its channel power exceeds the noise floor of the channel by `margin` dB, the
+    decoder scales the subcarriers so that they sum up to noise + rssi. It is explained if a WiFi frame of the
+    same sensor (see MultiSource) covers its TSF, `guard` TU around the frame included. As the airtime data may
+    lag behind, hot samples wait until the airtime stream has passed them, but at most `window` TU. Unexplained
+    hot samples on the same channel with gaps of at most `max_gap` TU form a burst, which is written to the log
+    once it is over.
+    The add methods and flush() may be called from different threads.
+    """
+
+    def __init__(self, log, margin=10.0, subcarrier_margin=10.0, guard=20, max_gap=2000, window=50000,
+                 reset=1000000):
+        self.log = log
+        self.margin = margin
+        self.subcarrier_margin = subcarrier_margin  # over the noise of a subcarrier, for the band of a burst
+        self.guard = guard
+        self.max_gap = max_gap
+        self.window = window
+        self.reset = reset
+        self.hot = 0
+        self.explained = 0
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.frame_start = np.zeros(0, dtype=np.int64)  # sorted
+        self.frame_end = np.zeros(0, dtype=np.int64)
+        self.frame_sensor = np.zeros(0, dtype=np.uint8)
+        self.pending = []  # candidate_dtype
+        self.open = {}  # freq_cf: burst_dtype record of the burst that may go on
+        self.spectral_newest = None
+        self.airtime_newest = None
+
+    def _check_reset(self, newest, tsf_max):
+        if newest is not None and tsf_max < newest - self.reset:
+            logger.info("TSF went back by %d TU, restarting the detector" % (newest - tsf_max))
+            self._flush()
+            self.clear()
+
+    def add_spectral(self, records):
+        if not len(records):
+            return
+        with self.lock:
+            self._add_spectral(records)
+
+    def _add_spectral(self, records):
+        tsf = records['tsf'].astype(np.int64)
+        self._check_reset(self.spectral_newest, int(tsf.max()))
+        self.spectral_newest = max(self.spectral_newest or 0, int(tsf.max()))
+        hot = np.flatnonzero(records['chan_pwr'] > records['noise'] + self.margin)
+        if len(hot):
+            r = records[hot]
+            valid = np.arange(MAX_BINS) < r['n_bins'][:, None]
+            # the share of the noise floor of one subcarrier
+            floor = r['noise'] - 10 * np.log10(np.maximum(r['n_bins'], 1))
+            above = valid & (r['pwr'] > (floor + self.subcarrier_margin)[:, None])
+            # the band of the subcarriers above the noise, or the whole channel if the power is spread out
+            band = np.where(above.any(axis=1)[:, None], above, valid)
+            candidates = np.zeros(len(r), dtype=candidate_dtype)
+            candidates['tsf'] = tsf[hot]
+            candidates['freq_cf'] = r['freq_cf']
+            candidates['freq_lo'] = np.where(band, r['freq'], np.inf).min(axis=1)
+            candidates['freq_hi'] = np.where(band, r['freq'], -np.inf).max(axis=1)
+            candidates['chan_pwr'] = r['chan_pwr']
+            candidates['sensor'] = r['sensor']
+            self.pending.append(candidates)
+            self.hot += len(r)
+        self.process()
+
+    def add_airtime(self, records):
+        if not len(records):
+            return
+        with self.lock:
+            self._add_airtime(records)
+
+    def _add_airtime(self, records):
+        start = records['tsf'].astype(np.int64)
+        self._check_reset(self.airtime_newest, int(start.max()))
+        end = start + np.maximum(records['length'], 0)
+        self.airtime_newest = max(self.airtime_newest or 0, int(start.max()))
+        start = np.concatenate((self.frame_start, start))
+        end = np.concatenate((self.frame_end, end))
+        sensor = np.concatenate((self.frame_sensor, records['sensor']))
+        order = np.argsort(start, kind="stable")  # a few sorted runs
+        self.frame_start, self.frame_end, self.frame_sensor = start[order], end[order], sensor[order]
+        self.process()
+
+    def horizon(self):
+        # hot samples up to this TSF can be decided
+        horizon = -1
+        if self.airtime_newest is not None:
+            horizon = self.airtime_newest - self.guard
+        if self.spectral_newest is not None:
+            horizon = max(horizon, self.spectral_newest - self.window)
+        return horizon
+
+    def process(self, horizon=None):
+        if horizon is None:
+            horizon = self.horizon()
+        if self.pending:
+            candidates = np.concatenate(self.pending)
+            candidates = candidates[np.argsort(candidates['tsf'], kind="stable")]
+            n = int(np.searchsorted(candidates['tsf'], horizon, side="right"))
+            self.pending = [candidates[n:]] if n < len(candidates) else []
+            ready = candidates[:n]
+            if len(ready):
+                unexplained = ready[~self.covered(ready['tsf'], ready['sensor'])]
+                self.explained += len(ready) - len(unexplained)
+                self.add_to_bursts(unexplained)
+        self.close_bursts(horizon)
+        # spectral samples may come in up to `window` TU behind the airtime data, keep the frames for them
+        keep = self.frame_end >= horizon - self.window
+        if not keep.all():
+            self.frame_start, self.frame_end = self.frame_start[keep], self.frame_end[keep]
+            self.frame_sensor = self.frame_sensor[keep]
+
+    def covered(self, tsf, sensor):
+        # True for the TSFs within a frame (+- guard) of the same sensor. The radios of a MultiSensor share
+        # one clock, but a frame on one of them says nothing about the channel of another.
+        covered = np.zeros(len(tsf), dtype=bool)
+        for s in np.unique(sensor):
+            frames = self.frame_sensor == s
+            if not frames.any():
+                continue
+            start, end = self.frame_start[frames], self.frame_end[frames]
+            samples = sensor == s
+            idx = np.searchsorted(start, tsf[samples] + self.guard, side="right") - 1
+            reach = np.maximum.accumulate(end)  # frames may overlap
+            covered[samples] = (idx >= 0) & (reach[np.maximum(idx, 0)] >= tsf[samples] - self.guard)
+        return covered
+
+    def add_to_bursts(self, samples):
+        if not len(samples):
+            return
+        samples = samples[np.lexsort((samples['tsf'], samples['freq_cf']))]
+        tsf = samples['tsf']
+        split = np.flatnonzero((np.diff(samples['freq_cf']) != 0) | (np.diff(tsf) > self.max_gap)) + 1
+        first = np.concatenate(([0], split))
+        last = np.concatenate((split, [len(samples)])) - 1
+        groups = np.zeros(len(first), dtype=burst_dtype)
+        groups['tsf_start'] = tsf[first]
+        groups['tsf_end'] = tsf[last]
+        groups['freq_cf'] = samples['freq_cf'][first]
+        groups['freq_lo'] = np.minimum.reduceat(samples['freq_lo'], first)
+        groups['freq_hi'] = np.maximum.reduceat(samples['freq_hi'], first)
+        groups['pwr_peak'] = np.maximum.reduceat(samples['chan_pwr'], first)
+        groups['samples'] = last - first + 1
+        closed = []
+        for group in groups:
+            freq_cf = float(group['freq_cf'])
+            burst = self.open.get(freq_cf)
+            if burst is not None and int(group['tsf_start']) - int(burst['tsf_end']) <= self.max_gap:
+                burst['tsf_end'] = max(burst['tsf_end'], group['tsf_end'])
+                burst['freq_lo'] = min(burst['freq_lo'], group['freq_lo'])
+                burst['freq_hi'] = max(burst['freq_hi'], group['freq_hi'])
+                burst['pwr_peak'] = max(burst['pwr_peak'], group['pwr_peak'])
+                burst['samples'] += group['samples']
+            else:
+                if burst is not None:
+                    closed.append(burst)
+                self.open[freq_cf] = group.copy()
+        self.log.append(np.array(closed, dtype=burst_dtype))
+
+    def close_bursts(self, horizon):
+        # bursts that cannot go on anymore
+        done = [freq_cf for freq_cf, burst in self.open.items() if int(burst['tsf_end']) + self.max_gap < horizon]
+        self.log.append(np.array([self.open.pop(freq_cf) for freq_cf in done], dtype=burst_dtype))
+
+    def flush(self):
+        # decides all pending samples and writes all open bursts, e.g. before the sensor is retuned
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.process(horizon=2 ** 62)
+        self.log.append(np.array(list(self.open.values()), dtype=burst_dtype))
+        self.open = {}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="query an event log of non-WiFi bursts")
+    parser.add_argument("log", help="event log file")
+    parser.add_argument("--tsf-min", type=int, default=0, metavar="TSF")
+    parser.add_argument("--tsf-max", type=int, default=2 ** 64 - 1, metavar="TSF")
+    parser.add_argument("--freq-min", type=float, default=-np.inf, metavar="MHZ")
+    parser.add_argument("--freq-max", type=float, default=np.inf, metavar="MHZ")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    if not os.path.exists(args.log):
+        parser.error("%s does not exist" % args.log)
+    log = EventLog(args.log, readonly=True)
+    bursts = log.query(args.tsf_min, args.tsf_max, args.freq_min, args.freq_max)
+    print("%20s %10s %8s %8s %8s %8s %8s" % ("tsf_start", "dur (TU)", "chan", "lo", "hi", "peak", "samples"))
+    for burst in bursts:
+        print("%20d %10d %8.0f %8.1f %8.1f %8.1f %8d" % (
+            burst['tsf_start'], burst['tsf_end'] - burst['tsf_start'], burst['freq_cf'], burst['freq_lo'],
+            burst['freq_hi'], burst['pwr_peak'], burst['samples']))
+    print("%d of %d bursts" % (len(bursts), len(log)))
+    log.close()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+
+"""
+Headless mode. Runs the sensor pipeline (or replays a capture) without a display and writes statistics per
+interval of sensor time (TSF) to a directory of compressed .npz files, a batch of intervals per file:
+
+    time                    wall clock at the end of the interval, s since the epoch
+    tsf_first, tsf_last     TSF range of the samples
+    samples, frames         number of spectral samples and airtime frames
+    hist                    per interval, frequency bin and power bin: number of subcarrier samples at that
+                            power level, hist_freq and hist_power hold the bin edges (MHz, dBm)
+    channel, channel_freq   the channels of the sensor, the chan_* values are per interval and channel:
+    chan_samples            spectral samples
+    chan_pwr_mean/_max      mean (of the linear power) and max channel power of the samples, dBm
+    chan_snr_mean           mean SNR of the samples (channel power over the noise floor), dB
+    chan_dwell              TU the sensor spent on the channel
+    chan_busy               TU of the frames seen on the channel, chan_utilisation = chan_busy / chan_dwell
+    chan_frames             frames, chan_fcs_bad of them with bad FCS, chan_fcs_error_rate the ratio
+
+Frames are counted to the channel of the newest spectral sample, which is exact in background mode and
+approximate in chanscan mode. The aggregates keep their size, so the memory use does not grow.
+
+    $ python3 dumper.py wlan0 --out stats --interval 10 --batch 30 --keep 288
+"""
+
+import os
+import sys
+import glob
+import time
+import signal
+import logging
+import argparse
+import numpy as np
+from spectrum import SpectrumHistogram
+from transport import QueueReader, pack_spectral, pack_airtime, spectral_power, channel_snr
+from metrics import Metrics, MetricsExporter
+from pipeline import SensorPipeline
+from capture import CaptureReader, CapturePlayer, ReplaySensor
+logger = logging.getLogger(__name__)
+
+
+class IntervalStats(object):
+    """
+    Aggregates of the samples of one interval, clear() starts the next one.
+    """
+
+    def __init__(self, freqchan, power_min=-130.0, power_max=-20.0, power_res=1.0, freq_res=0.3125,
+                 max_gap=100000):
+        freqchan = sorted(freqchan)
+        self.channel_freq = np.array([freq for (freq, chan) in freqchan], dtype=np.float64)
+        self.channel = np.array([chan for (freq, chan) in freqchan], dtype=np.int32)
+        freq_min = self.channel_freq[0] - 10
+        freq_max = self.channel_freq[-1] + 10
+        # one frequency bin per subcarrier
+        self.histogram = SpectrumHistogram(freq_min, freq_max, power_min, power_max,
+                                           freq_bins=round((freq_max - freq_min) / freq_res), power_res=power_res)
+        self.max_gap = max_gap  # in TU, longer pauses between two samples do not count as dwell time
+        self.chan_now = None  # channel index of the newest spectral sample
+        self.tsf_prev = None  # TSF of the newest spectral sample
+        n = len(self.channel)
+        self.chan_samples = np.zeros(n, dtype=np.int64)
+        self.chan_lin = np.zeros(n, dtype=np.float64)
+        self.chan_pwr_max = np.zeros(n, dtype=np.float64)
+        self.chan_snr = np.zeros(n, dtype=np.float64)  # sum over the samples with power
+        self.chan_snr_samples = np.zeros(n, dtype=np.int64)
+        self.chan_dwell = np.zeros(n, dtype=np.float64)
+        self.chan_busy = np.zeros(n, dtype=np.int64)
+        self.chan_frames = np.zeros(n, dtype=np.int64)
+        self.chan_fcs_bad = np.zeros(n, dtype=np.int64)
+        self.clear()
+
+    def clear(self):
+        self.tsf_first = None
+        self.tsf_last = None
+        self.samples = 0
+        self.frames = 0
+        self.histogram.clear()
+        for values in (self.chan_samples, self.chan_lin, self.chan_snr, self.chan_snr_samples, self.chan_dwell,
+                       self.chan_busy, self.chan_frames, self.chan_fcs_bad):
+            values.fill(0)
+        self.chan_pwr_max.fill(-np.inf)
+
+    def layout(self):
+        # the values that are the same for all intervals
+        h = self.histogram
+        return {
+            "hist_freq": np.linspace(h.freq_min, h.freq_max, h.freq_bins + 1),
+            "hist_power": np.linspace(h.power_min, h.power_max, h.power_bins + 1),
+            "channel": self.channel,
+            "channel_freq": self.channel_freq,
+        }
+
+    def channel_index(self, freqs):
+        # nearest channel of the center frequencies
+        if len(self.channel_freq) == 1:
+            return np.zeros(len(freqs), dtype=np.intp)
+        idx = np.clip(np.searchsorted(self.channel_freq, freqs), 1, len(self.channel_freq) - 1)
+        closer_below = freqs - self.channel_freq[idx - 1] < self.channel_freq[idx] - freqs
+        return np.where(closer_below, idx - 1, idx)
+
+    def note_tsf(self, tsf):
+        first, last = int(tsf.min()), int(tsf.max())
+        self.tsf_first = first if self.tsf_first is None else min(self.tsf_first, first)
+        self.tsf_last = last if self.tsf_last is None else max(self.tsf_last, last)
+
+    def add_spectral(self, records):
+        if not len(records):
+            return
+        n = len(self.channel)
+        self.samples += len(records)
+        self.note_tsf(records['tsf'])
+        self.histogram.add(*spectral_power(records))
+        chan = self.channel_index(records['freq_cf'].astype(np.float64))
+        pwr = records['chan_pwr'].astype(np.float64)
+        self.chan_samples += np.bincount(chan, minlength=n)
+        self.chan_lin += np.bincount(chan, weights=10 ** (pwr / 10), minlength=n)
+        np.maximum.at(self.chan_pwr_max, chan, pwr)
+        snr = channel_snr(records)
+        has_pwr = snr > -200
+        self.chan_snr += np.bincount(chan[has_pwr], weights=snr[has_pwr], minlength=n)
+        self.chan_snr_samples += np.bincount(chan[has_pwr], minlength=n)
+        # the time between two samples counts to the channel of the later one
+        tsf = records['tsf'].astype(np.int64)
+        gap = np.diff(tsf, prepend=tsf[0] if self.tsf_prev is None else self.tsf_prev)
+        gap[(gap < 0) | (gap > self.max_gap)] = 0
+        self.chan_dwell += np.bincount(chan, weights=gap, minlength=n)
+        self.tsf_prev = int(tsf[-1])
+        self.chan_now = int(chan[-1])
+
+    def add_airtime(self, records):
+        if not len(records):
+            return
+        self.frames += len(records)
+        self.note_tsf(records['tsf'])
+        if self.chan_now is None:  # no idea where the sensor is yet
+            return
+        self.chan_busy[self.chan_now] += int(np.maximum(records['length'], 0).sum())
+        self.chan_frames[self.chan_now] += len(records)
+        self.chan_fcs_bad[self.chan_now] += int(np.count_nonzero(records['is_fcs_bad']))
+
+    def snapshot(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return {
+                "time": time.time(),
+                "tsf_first": self.tsf_first or 0,
+                "tsf_last": self.tsf_last or 0,
+                "samples": self.samples,
+                "frames": self.frames,
+                "hist": self.histogram.counts.astype(np.uint32),
+                "chan_samples": self.chan_samples.copy(),
+                "chan_pwr_mean": np.where(self.chan_samples > 0, 10 * np.log10(self.chan_lin / self.chan_samples),
+                                          np.nan).astype(np.float32),
+                "chan_pwr_max": np.where(self.chan_samples > 0, self.chan_pwr_max, np.nan).astype(np.float32),
+                "chan_snr_mean": (self.chan_snr / self.chan_snr_samples).astype(np.float32),
+                "chan_dwell": self.chan_dwell.astype(np.int64),
+                "chan_busy": self.chan_busy.copy(),
+                "chan_utilisation": (self.chan_busy / self.chan_dwell).astype(np.float32),
+                "chan_frames": self.chan_frames.copy(),
+                "chan_fcs_bad": self.chan_fcs_bad.copy(),
+                "chan_fcs_error_rate": (self.chan_fcs_bad / self.chan_frames).astype(np.float32),
+            }
+
+
+class StatsWriter(object):
+    """
+    Collects the snapshots of `batch` intervals in preallocated arrays and writes them as one compressed
+    .npz file, so the storage sees one write per batch. With `keep`, only the newest keep files are kept.
+    """
+
+    def __init__(self, directory, layout, batch=30, keep=None, prefix="athstats"):
+        self.directory = directory
+        self.layout = layout
+        self.batch = batch
+        self.keep = keep
+        self.prefix = prefix
+        self.rows = None  # name: array of batch values
+        self.n = 0
+        self.files = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, stats):
+        if self.rows is None:
+            self.rows = {}
+            for name, value in stats.items():
+                value = np.asarray(value)
+                self.rows[name] = np.empty((self.batch,) + value.shape, dtype=value.dtype)
+        for name, value in stats.items():
+            self.rows[name][self.n] = value
+        self.n += 1
+        if self.n == self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.n:
+            return
+        t = self.rows["time"][0]
+        name = "%s-%s-%03d.npz" % (self.prefix, time.strftime("%Y%m%d-%H%M%S", time.localtime(t)), int(t * 1000) % 1000)
+        path = os.path.join(self.directory, name)
+        arrays = {name: values[:self.n] for (name, values) in self.rows.items()}
+        arrays.update(self.layout)
+        tmp = path + ".tmp"  # readers never see a partial file
+        with open(tmp, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp, path)
+        logger.debug("wrote %d intervals to %s" % (self.n, path))
+        self.n = 0
+        self.files += 1
+        self.rotate()
+
+    def rotate(self):
+        if not self.keep:
+            return
+        files = sorted(glob.glob(os.path.join(self.directory, self.prefix + "-*.npz")))
+        for path in files[:-self.keep]:
+            os.remove(path)
+
+
+class Dumper(object):
+
+    def __init__(self, sensor, ath_queue_in, airtime_queue_in, directory, interval=10.0, batch=30, keep=None):
+        self.sensor = sensor
+        # a plain queue, a SharedRingBuffer or a ReplaySource will do
+        if hasattr(ath_queue_in, "read"):
+            self.ath_source = ath_queue_in
+        else:
+            self.ath_source = QueueReader(ath_queue_in, pack_spectral)
+        if hasattr(airtime_queue_in, "read"):
+            self.airtime_source = airtime_queue_in
+        else:
+            self.airtime_source = QueueReader(airtime_queue_in, pack_airtime)
+        self.stats = IntervalStats(sensor.get_supported_freqchan())
+        self.writer = StatsWriter(directory, self.stats.layout(), batch=batch, keep=keep)
+        self.interval = int(interval * 1e6)  # in TU
+        self.ingest_interval = 0.05  # s to wait if there are no new samples
+        self.metrics = Metrics()
+        self.dropped = 0
+        self.running = True
+
+    def quit(self, *args):
+        self.running = False
+
+    def update(self):
+        count = 0
+        for (source, add, name) in ((self.ath_source, self.stats.add_spectral, "ath_samples"),
+                                    (self.airtime_source, self.stats.add_airtime, "airtime_frames")):
+            while True:
+                with self.metrics.timed("read"):
+                    records = source.read()
+                if not len(records):
+                    break
+                count += len(records)
+                self.metrics.count(name, len(records))
+                with self.metrics.timed("aggregate"):
+                    add(records)
+        if self.stats.tsf_first is not None and self.stats.tsf_last - self.stats.tsf_first >= self.interval:
+            self.close_interval()
+        dropped = self.ath_source.dropped + self.airtime_source.dropped
+        if dropped > self.dropped:
+            logger.warning("transport overflow, %d records dropped (%d total)" % (dropped - self.dropped, dropped))
+            self.dropped = dropped
+        return count
+
+    def close_interval(self):
+        with self.metrics.timed("write"):
+            self.writer.add(self.stats.snapshot())
+        self.stats.clear()
+
+    def run(self, done=None):
+        # until quit() or done() returns True
+        while self.running and not (done is not None and done()):
+            if not self.update():
+                time.sleep(self.ingest_interval)
+            self.metrics.gauge("transport_dropped", self.dropped)
+            self.metrics.tick()
+        if self.stats.tsf_first is not None:
+            self.close_interval()
+        self.writer.flush()
+        logger.info("wrote %d files to %s" % (self.writer.files, self.writer.directory))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="headless ISM spectrum statistics based on the ath9k spectral scan")
+    parser.add_argument("interface", nargs="?", help="wifi interface of the sensor")
+    parser.add_argument("--out", default="stats", metavar="DIR", help="directory of the .npz files (default: stats)")
+    parser.add_argument("--interval", type=float, default=10, metavar="SECONDS",
+                        help="length of an interval (default: 10)")
+    parser.add_argument("--batch", type=int, default=30, help="intervals per file (default: 30)")
+    parser.add_argument("--keep", type=int, metavar="N", help="keep only the newest N files")
+    parser.add_argument("--mode", choices=["background", "chanscan"], default="background",
+                        help="mode of the sensor (default: background)")
+    parser.add_argument("--channel", type=int, default=1, help="channel in background mode (default: 1)")
+    parser.add_argument("--transport", choices=["queue", "shm"], default="queue",
+                        help="pass decoded samples via multiprocessing queues or shared memory ring buffers")
+    parser.add_argument("--min-decoders", type=int, default=1, metavar="N",
+                        help="decoder processes the sensor keeps running (default: 1)")
+    parser.add_argument("--max-decoders", type=int, default=None, metavar="N",
+                        help="decoder processes the sensor grows to under load (default: number of CPUs)")
+    parser.add_argument("--replay", metavar="FILE", help="replay a capture file instead of using a sensor")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="replay speed as multiple of real time, 0 means as fast as possible (default: 0)")
+    parser.add_argument("--metrics", metavar="TARGET",
+                        help="periodically write performance metrics as JSON to a file or to udp:<host>:<port>")
+    args = parser.parse_args()
+    if not args.interface and not args.replay:
+        parser.error("either an interface or --replay is required")
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    done = None
+    if args.replay:
+        reader = CaptureReader(args.replay)
+        player = CapturePlayer(reader, speed=args.speed)
+        sensor = ReplaySensor(reader.sensor)
+        ath_queue, airtime_queue = player.spectral, player.airtime
+        done = lambda: player.finished
+    else:
+        pipeline = SensorPipeline(args.interface, args.transport, args.min_decoders, args.max_decoders)
+        sensor = pipeline.scanner
+        if args.mode == "chanscan":
+            sensor.set_mode("chanscan")
+        else:
+            sensor.set_channel(args.channel)
+        pipeline.start()
+        ath_queue, airtime_queue = pipeline.spectral, pipeline.airtime
+
+    dumper = Dumper(sensor, ath_queue, airtime_queue, args.out, interval=args.interval, batch=args.batch,
+                    keep=args.keep)
+    signal.signal(signal.SIGTERM, dumper.quit)
+    exporter = None
+    if args.metrics:
+        exporter = MetricsExporter(dumper.metrics, args.metrics)
+        exporter.start()
+
+    try:
+        dumper.run(done)
+    except KeyboardInterrupt:
+        dumper.quit()
+        dumper.run(lambda: True)  # write what is left
+
+    if exporter is not None:
+        exporter.stop()
+    if args.replay:
+        reader.close()
+    else:
+        pipeline.stop()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+"""
+Synthetic stand-ins for AthSpectralScanner (+ decoder) and AirtimeCalculator, to run and benchmark
+the UI without ath9k hardware. Both produce items in the same format as the real pipeline.
+"""
+
+import time
+import math
+import random
+import logging
+import threading
+from decoderpool import DecoderPool
+logger = logging.getLogger(__name__)
+
+CHANNELS_24 = [(2407 + 5 * ch, ch) for ch in range(1, 14)]
+CHANNELS_5 = [(5000 + 5 * ch, ch) for ch in (*range(36, 65, 4), *range(100, 141, 4), *range(149, 166, 4))]
+SUBCARRIER_WIDTH = 0.3125  # MHz
+
+
+def make_sample(rnd, ht_mode, interferer_freq, tsf, freq_cf):
+    n = 128 if ht_mode == "HT40" else 56
+    first = freq_cf - (n // 2) * SUBCARRIER_WIDTH
+    if ht_mode == "HT40":
+        first += 10  # HT40+, secondary channel above
+    wifi = rnd.random() < 0.3
+    wifi_pwr = rnd.gauss(-65, 8)
+    burst = (tsf // 8000) % 2 == 0 and rnd.random() < 0.5  # interferer on half of the time
+    pwr = {}
+    for i in range(n):
+        f = first + i * SUBCARRIER_WIDTH
+        p = rnd.gauss(-95, 3)
+        if wifi and abs(f - freq_cf) < 8.5:
+            p = max(p, wifi_pwr + rnd.gauss(0, 2))
+        if burst and abs(f - interferer_freq) < 1.5:
+            p = max(p, rnd.gauss(-50, 3))
+        pwr[f] = p
+    # like the decoder does it, noise is the floor of the whole channel and the subcarriers sum up to noise + rssi
+    noise = -95 + 10 * math.log10(n)
+    rssi = int(round(10 * math.log10(sum(10 ** (p / 10) for p in pwr.values())) - noise))
+    return tsf, (tsf, freq_cf, noise, rssi, pwr)
+
+
+def decode_chunk(chunk):
+    """
+    The expensive part of the fake pipeline, for a DecoderPool: turns a chunk (ht_mode, interferer_freq,
+    seed, [(tsf, freq_cf), ...]) as put by FakeSensor into samples.
+    """
+    ht_mode, interferer_freq, seed, schedule = chunk
+    rnd = random.Random(seed)
+    return [make_sample(rnd, ht_mode, interferer_freq, tsf, freq_cf) for (tsf, freq_cf) in schedule]
+
+
+class FakeSensor(object):
+    """
+    Behaves like an AthSpectralScanner with attached AthSpectralScanDecoder: once started, decoded
+    samples are put into the output queue at a realistic rate.
+    In background mode, samples come in bursts, in chanscan mode spectral_count samples per channel.
+    With a decoder (e.g. a DecoderPool around decode_chunk), the sensor only puts the timing of the samples
+    into it and leaves the synthesis to the decoder, like the real scanner does with the raw data.
+    """
+
+    def __init__(self, output_queue=None, freqchan=CHANNELS_24, bg_rate=8000, dwell_time=8000, seed=None,
+                 decoder=None):
+        self.output_queue = output_queue
+        self.decoder = decoder
+        self.freqchan = list(freqchan)
+        self.bg_rate = bg_rate  # samples/s in background mode
+        self.dwell_time = dwell_time  # us per channel in chanscan mode
+        self.rnd = random.Random(seed)
+        self.mode = "background"
+        self.current_chan, self.current_freq = self.freqchan[0][1], self.freqchan[0][0]
+        self.current_ht_mode = "HT20"
+        self.spectral_count = 8
+        self.tsf = 0
+        self.interferer_freq = 2450.0  # a narrow band, bursty non-WiFi source (e.g. a microwave oven)
+        self.thread = None
+        self.running = False
+
+    # AthSpectralScanner API
+    def get_supported_freqchan(self):
+        return self.freqchan
+
+    def get_mode(self):
+        return self.mode
+
+    def set_mode(self, mode):
+        self.mode = mode
+
+    def set_mode_background(self):
+        self.mode = "background"
+
+    def set_mode_chanscan(self):
+        self.mode = "chanscan"
+
+    def set_channel(self, ch):
+        for freq, chan in self.freqchan:
+            if chan == ch:
+                self.current_chan, self.current_freq = chan, freq
+
+    def set_HT_mode(self, ht_mode):
+        self.current_ht_mode = ht_mode
+
+    def get_spectral_count(self):
+        return self.spectral_count
+
+    def set_spectral_count(self, count):
+        self.spectral_count = count
+
+    def set_spectral_short_repeat(self, repeat):
+        pass
+
+    def start(self):
+        if (self.output_queue is None and self.decoder is None) or self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        # produce in real time, in slices of 10 ms
+        last = time.monotonic()
+        while self.running:
+            time.sleep(0.01)
+            now = time.monotonic()
+            duration = int((now - last) * 1e6)
+            if self.decoder is not None:
+                self.decoder.put((self.current_ht_mode, self.interferer_freq, self.rnd.random(),
+                                  self.schedule(duration)))
+            else:
+                for item in self.generate(duration):
+                    self.output_queue.put(item)
+            last = now
+
+    # sample generation
+    def n_bins(self):
+        return 128 if self.current_ht_mode == "HT40" else 56
+
+    def make_sample(self, tsf, freq_cf):
+        return make_sample(self.rnd, self.current_ht_mode, self.interferer_freq, tsf, freq_cf)
+
+    def schedule(self, duration):
+        """
+        Returns the timing of the samples of the next `duration` us as list of (tsf, freq_cf).
+        """
+        schedule = []
+        end = self.tsf + duration
+        if self.mode == "chanscan":
+            idx = [chan for (freq, chan) in self.freqchan].index(self.current_chan)
+            while self.tsf < end:
+                self.current_freq, self.current_chan = self.freqchan[idx]
+                step = self.dwell_time // max(self.spectral_count, 1)
+                for i in range(self.spectral_count):
+                    schedule.append((self.tsf + i * step, self.current_freq))
+                self.tsf += self.dwell_time
+                idx = (idx + 1) % len(self.freqchan)
+        else:
+            # bursts of 10 .. 200 samples with the mean rate of bg_rate
+            gap = 1e6 / self.bg_rate
+            while self.tsf < end:
+                burst = self.rnd.randint(10, 200)
+                for i in range(burst):
+                    schedule.append((self.tsf, self.current_freq))
+                    self.tsf += int(gap / 2)
+                self.tsf += int(burst * gap / 2)
+        return schedule
+
+    def generate(self, duration):
+        """
+        Returns the samples of the next `duration` us as list of (ts, (tsf, freq_cf, noise, rssi, pwr)).
+        """
+        return [self.make_sample(tsf, freq_cf) for (tsf, freq_cf) in self.schedule(duration)]
+
+
+class FakeAirtime(object):
+    """
+    Behaves like an AirtimeCalculator: WiFi frames as (tsf, length, pwr, _, is_fcs_bad, _), sharing the
+    TSF clock of the given FakeSensor.
+    """
+
+    def __init__(self, sensor, output_queue=None, frame_rate=1500, fcs_error_rate=0.05, seed=None):
+        self.sensor = sensor
+        self.output_queue = output_queue
+        self.frame_rate = frame_rate
+        self.fcs_error_rate = fcs_error_rate
+        self.rnd = random.Random(seed)
+        self.tsf = 0
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        if self.output_queue is None or self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while self.running:
+            time.sleep(0.01)
+            for item in self.generate():
+                self.output_queue.put(item)
+
+    def generate(self):
+        """
+        Returns the frames up to the current TSF of the sensor.
+        """
+        items = []
+        rnd = self.rnd
+        if self.tsf < self.sensor.tsf - 1000000:  # do not catch up for more than a second
+            self.tsf = self.sensor.tsf - 1000000
+        while self.tsf < self.sensor.tsf:
+            self.tsf += int(rnd.expovariate(self.frame_rate / 1e6)) + 1
+            length = rnd.choice((44, 44, 60, 180, 300, 1500, 2800, 5400))  # ACKs, beacons, data, aggregates
+            pwr = "%d" % rnd.gauss(-60, 10)
+            items.append((self.tsf, length, pwr, self.sensor.current_freq, rnd.random() < self.fcs_error_rate, 0))
+            self.tsf += length
+        return items
+
+
+class FakePipeline(object):
+    """
+    Stands in for a SensorPipeline: a FakeSensor with a DecoderPool of min_decoders .. max_decoders processes
+    and a FakeAirtime, delivering into the given spectral and airtime transports.
+    """
+
+    def __init__(self, freqchan=CHANNELS_24, spectral=None, airtime=None, min_decoders=1, max_decoders=None,
+                 bg_rate=8000, seed=None):
+        self.spectral = spectral
+        self.airtime = airtime
+        self.decoder = DecoderPool(decode_chunk, spectral, min_workers=min_decoders, max_workers=max_decoders)
+        self.scanner = FakeSensor(freqchan=freqchan, bg_rate=bg_rate, seed=seed, decoder=self.decoder)
+        self.airtimecalc = FakeAirtime(self.scanner, airtime, seed=seed)
+
+    def start(self):
+        self.decoder.start()
+        self.scanner.start()
+        self.airtimecalc.start()
+
+    def stop(self):
+        self.scanner.stop()
+        self.airtimecalc.stop()
+        self.decoder.stop()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import numpy as np
+from waterfall import pwr_to_intensity
+logger = logging.getLogger(__name__)
+
+EMPTY = -128  # max power of a bucket without events
+NO_BUCKET = np.iinfo(np.int64).min
+# event classes, in the order of the channels of a bucket
+(cls_spectral, cls_frame, cls_frame_bad) = range(3)
+
+
+class HistoryLevel(object):
+    """
+    One level of detail: a ring of time buckets of bucket_tu TU each. Per bucket and event class, it
+    holds the max power (dBm), and sum (mW) and count of the events for the mean.
+    """
+
+    def __init__(self, bucket_tu, capacity):
+        self.bucket_tu = bucket_tu
+        self.capacity = capacity
+        self.tag = np.full(capacity, NO_BUCKET, dtype=np.int64)  # absolute bucket number held by a slot
+        self.max = np.full((capacity, 3), EMPTY, dtype=np.int8)
+        self.sum = np.zeros((capacity, 3), dtype=np.float32)
+        self.count = np.zeros((capacity, 3), dtype=np.uint32)
+
+    def clear(self):
+        self.tag.fill(NO_BUCKET)
+
+    def add(self, tsf, length, cls, pwr, lin):
+        # a frame counts into every bucket it covers
+        first = tsf // self.bucket_tu
+        n = (tsf + np.maximum(length, 0)) // self.bucket_tu - first + 1
+        start = np.cumsum(n) - n
+        bucket = np.repeat(first - start, n) + np.arange(n.sum())
+        cls, pwr, lin = np.repeat(cls, n), np.repeat(pwr, n), np.repeat(lin, n)
+        slot = bucket % self.capacity
+        stale = self.tag[slot] != bucket
+        if stale.any():  # the slot still holds an older bucket, recycle it
+            recycled = slot[stale]
+            self.tag[recycled] = bucket[stale]
+            self.max[recycled] = EMPTY
+            self.sum[recycled] = 0
+            self.count[recycled] = 0
+        np.maximum.at(self.max, (slot, cls), pwr)
+        np.add.at(self.sum, (slot, cls), lin)
+        np.add.at(self.count, (slot, cls), 1)
+
+    def oldest(self, newest_tsf):
+        # first TSF this level still holds
+        return (newest_tsf // self.bucket_tu - self.capacity + 1) * self.bucket_tu
+
+    def get(self, first, n):
+        """
+        Returns max, sum and count of the buckets first .. first + n - 1 (absolute numbers).
+        """
+        bucket = np.arange(first, first + n, dtype=np.int64)
+        slot = bucket % self.capacity
+        valid = (self.tag[slot] == bucket)[:, None]
+        return (np.where(valid, self.max[slot], EMPTY), np.where(valid, self.sum[slot], 0),
+                np.where(valid, self.count[slot], 0))
+
+
+class History(object):
+    """
+    Time indexed history of the heatmap events, as a pyramid of levels with bucket_tu * factor ** level TU
+    per bucket. Every level holds at most `retention` TU, and never more than max_buckets buckets, so the
+    fine levels only reach back a few seconds and older parts of the history are rendered in less detail.
+    """
+
+    def __init__(self, base_tu=16, factor=4, levels=7, retention=300000000, max_buckets=65536):
+        self.retention = retention
+        self.levels = []
+        for i in range(levels):
+            bucket_tu = base_tu * factor ** i
+            capacity = int(min(max_buckets, -(-retention // bucket_tu)))
+            self.levels.append(HistoryLevel(bucket_tu, capacity))
+        self.tsf_first = None
+        self.tsf_newest = None
+
+    def clear(self):
+        for level in self.levels:
+            level.clear()
+        self.tsf_first = None
+        self.tsf_newest = None
+
+    def add(self, events):
+        if not len(events):
+            return
+        tsf = events['tsf'].astype(np.int64)
+        length = events['length'].astype(np.int64)
+        pwr = events['pwr'].astype(np.float64)
+        cls = np.where(length == -1, cls_spectral, np.where(events['is_fcs_bad'], cls_frame_bad, cls_frame))
+        lin = (10 ** (pwr / 10)).astype(np.float32)
+        pwr = np.clip(np.round(pwr), EMPTY + 1, 127).astype(np.int8)
+        for level in self.levels:
+            level.add(tsf, length, cls, pwr, lin)
+        newest = int(tsf.max())
+        if self.tsf_newest is None or newest > self.tsf_newest:
+            self.tsf_newest = newest
+        if self.tsf_first is None:
+            self.tsf_first = int(tsf.min())
+
+    def oldest(self):
+        # first TSF that is still in the history
+        if self.tsf_newest is None:
+            return None
+        return max(self.tsf_first, self.levels[-1].oldest(self.tsf_newest))
+
+    def level_for(self, tsf_start, tu_per_px):
+        # the coarsest level that is not coarser than a pixel and still reaches back to tsf_start
+        candidates = [level for level in self.levels if level.bucket_tu <= tu_per_px] or self.levels[:1]
+        level = candidates[-1]
+        for level in self.levels[self.levels.index(level):]:
+            if level.oldest(self.tsf_newest) <= tsf_start:
+                break
+        return level
+
+    def render(self, tsf_start, n_px, tu_per_px, stat="max"):
+        """
+        Returns the colors of n_px pixels of tu_per_px TU each from tsf_start on, in the colors of the waterfall:
+        spectral samples green, frames blue, frames with bad FCS red. `stat` is "max" or "mean" power.
+        """
+        rgb = np.zeros((n_px, 3), dtype=np.uint8)
+        if self.tsf_newest is None or tsf_start > self.tsf_newest:
+            return rgb
+        tsf_start = int(tsf_start)
+        full = rgb
+        n_px = min(n_px, (self.tsf_newest - tsf_start) // tu_per_px + 1)  # nothing to render after the newest event
+        rgb = full[:n_px]
+        level = self.level_for(tsf_start, tu_per_px)
+        bt = level.bucket_tu
+        px_start = tsf_start + np.arange(n_px + 1, dtype=np.int64) * tu_per_px
+        lo = px_start[:-1] // bt
+        hi = np.maximum(px_start[1:] // bt, lo + 1)
+        first = int(lo[0])
+        bmax, bsum, bcount = level.get(first, int(hi[-1]) - first)
+        # reduceat over the buckets of each pixel. A pixel smaller than a bucket gets the whole bucket.
+        if stat == "mean":
+            total = np.add.reduceat(bsum, lo - first, axis=0)
+            count = np.add.reduceat(bcount, lo - first, axis=0)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                pwr = np.where(count > 0, 10 * np.log10(total / np.maximum(count, 1)), np.nan)
+        else:
+            top = np.maximum.reduceat(bmax, lo - first, axis=0)
+            pwr = np.where(top > EMPTY, top, np.nan)
+        intensity = pwr_to_intensity(np.nan_to_num(pwr, nan=-200.0).ravel()).reshape(pwr.shape)
+        rgb[:, 1] = intensity[:, cls_spectral]  # Green
+        rgb[:, 2] = intensity[:, cls_frame]  # Blue
+        rgb[:, 0] = intensity[:, cls_frame_bad]  # Red
+        return full
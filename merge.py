@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import numpy as np
+logger = logging.getLogger(__name__)
+
+
+class TsfMerger(object):
+    """
+    Merges the record streams of several sources into one stream ordered by TSF.
+
+    Records are held back until every stream has moved past them, but at most `window` TU behind the
+    newest record, so a silent stream does not stall the output. Records older than what was already
+    released are late: they are counted and dropped, the output never goes back in time.
+    A stream that jumps back by more than `reset` TU restarts the timeline (e.g. a reloaded driver).
+    """
+
+    def __init__(self, dtype, streams=2, window=50000, reset=1000000):
+        self.dtype = dtype
+        self.streams = streams
+        self.window = window
+        self.reset = reset
+        self.late = 0
+        self.clear()
+
+    def clear(self):
+        self.held = np.zeros(0, dtype=self.dtype)  # sorted, not yet released
+        self.incoming = []
+        self.newest = [None] * self.streams
+        self.released_tsf = None
+
+    def push(self, stream, records):
+        """
+        Adds records of a stream, returns the number of late records dropped.
+        """
+        if not len(records):
+            return 0
+        tsf = records['tsf']
+        late = 0
+        if self.released_tsf is not None:
+            if int(tsf.max()) < self.released_tsf - self.reset:
+                logger.info("TSF of stream %d went back by %d TU, restarting the timeline" % (
+                    stream, self.released_tsf - int(tsf.max())))
+                self.clear()
+            else:
+                is_late = tsf < self.released_tsf
+                late = int(np.count_nonzero(is_late))
+                if late:
+                    self.late += late
+                    records = records[~is_late]
+                    if not len(records):
+                        return late
+        self.incoming.append(records)
+        newest = int(records['tsf'].max())
+        if self.newest[stream] is None or newest > self.newest[stream]:
+            self.newest[stream] = newest
+        return late
+
+    def pending(self):
+        return len(self.held) + sum(len(records) for records in self.incoming)
+
+    def pop(self):
+        """
+        Returns the records that are complete, in TSF order.
+        """
+        seen = [newest for newest in self.newest if newest is not None]
+        if not seen or not self.incoming:
+            return self.held[:0]
+        watermark = max(seen) - self.window
+        if len(seen) == self.streams:
+            watermark = max(watermark, min(seen))
+        # every stream arrives (nearly) in order, so this is a stable merge of a few sorted runs, which
+        # timsort does in O(n log k)
+        records = np.concatenate([self.held] + self.incoming)
+        records = records[np.argsort(records['tsf'], kind="stable")]
+        n = int(np.searchsorted(records['tsf'], watermark, side="right"))
+        self.held = records[n:]
+        self.incoming = []
+        if self.released_tsf is None or watermark > self.released_tsf:
+            self.released_tsf = watermark
+        return records[:n]
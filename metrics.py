@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+logger = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """
+    Collects stage timings, counters and gauges. Every `window` seconds, tick() rolls the collected values
+    over into `last`, a flat dict that the overlay and the exporter show:
+
+        <stage>_ms, <stage>_max_ms   mean and max time per call of a stage
+        <counter>_per_s              rate of a counter
+        <counter>_total              counter since start
+        <gauge>                      last value of a gauge
+    """
+
+    def __init__(self, window=1.0):
+        self.window = window
+        self.lock = threading.Lock()
+        self.timings = {}  # stage: [calls, total s, max s]
+        self.counters = {}
+        self.totals = {}
+        self.gauges = {}
+        self.window_start = time.monotonic()
+        self.last = {}
+
+    @contextmanager
+    def timed(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            with self.lock:
+                timing = self.timings.setdefault(stage, [0, 0.0, 0.0])
+                timing[0] += 1
+                timing[1] += dt
+                timing[2] = max(timing[2], dt)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+            self.totals[name] = self.totals.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def tick(self):
+        """
+        Rolls the window over if it is complete. Returns True if `last` was updated.
+        """
+        now = time.monotonic()
+        duration = now - self.window_start
+        if duration < self.window:
+            return False
+        snapshot = {"time": time.time(), "window_s": round(duration, 3)}
+        with self.lock:
+            for stage, (calls, total, longest) in self.timings.items():
+                snapshot[stage + "_ms"] = round(1000 * total / calls, 3) if calls else 0.0
+                snapshot[stage + "_max_ms"] = round(1000 * longest, 3)
+            for name, total in self.totals.items():
+                snapshot[name + "_per_s"] = round(self.counters.get(name, 0) / duration, 1)
+                snapshot[name + "_total"] = total
+            snapshot.update(self.gauges)
+            self.timings = {}
+            self.counters = {}
+        self.window_start = now
+        self.last = snapshot
+        return True
+
+
+class MetricsExporter(object):
+    """
+    Periodically writes the last metrics snapshot as JSON, either to a file (replaced atomically, so it can
+    be polled) or as UDP datagram if the target is given as udp:<host>:<port>.
+    """
+
+    def __init__(self, metrics, target, interval=1.0):
+        self.metrics = metrics
+        self.target = target
+        self.interval = interval
+        self.sock = None
+        if target.startswith("udp:"):
+            _, host, port = target.split(":")
+            self.address = (host, int(port))
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        if self.sock is not None:
+            self.sock.close()
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.interval)
+            if self.metrics.last:
+                self.export(self.metrics.last)
+
+    def export(self, snapshot):
+        data = json.dumps(snapshot, sort_keys=True).encode()
+        try:
+            if self.sock is not None:
+                self.sock.sendto(data, self.address)
+            else:
+                tmp = self.target + ".tmp"
+                with open(tmp, "wb") as f:
+                    f.write(data + b"\n")
+                os.replace(tmp, self.target)
+        except OSError as e:
+            logger.warning("metrics export to %s failed: %s" % (self.target, e))
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+"""
+Several sensors (e.g. one radio for 2.4 GHz and one for 5 GHz) in one UI. Every sensor pipeline runs in its
+own worker process and delivers into its own transports. The UI sees them as one sensor that supports the
+channels of all of them, and one pair of sources that read from all of them:
+
+    multi = MultiSensor({"wlan0": partial(SensorPipeline, "wlan0"), "wlan1": partial(SensorPipeline, "wlan1")})
+    multi.start()
+    ui = SimpleUI(athscanner=multi.scanner, ath_queue_in=multi.spectral, airtime_queue_in=multi.airtime)
+"""
+
+import time
+import logging
+import multiprocessing as mp
+import numpy as np
+from transport import QueueReader, EpochQueue, SpectralRingBuffer, AirtimeRingBuffer, pack_spectral, pack_airtime
+logger = logging.getLogger(__name__)
+
+
+def _run_worker(factory, spectral, airtime, conn):
+    # runs in the worker process: builds the pipeline and executes the scanner calls of the UI side
+    pipeline = factory(spectral=spectral, airtime=airtime)
+    pipeline.start()
+    scanner = pipeline.scanner
+    try:
+        while True:
+            call = conn.recv()
+            if call is None:
+                break
+            method, args = call
+            try:
+                result, error = getattr(scanner, method)(*args), None
+            except Exception as e:
+                result, error = None, e
+            state = (scanner.current_chan, scanner.current_freq, scanner.current_ht_mode)
+            conn.send((result, state, error))
+    finally:
+        pipeline.stop()
+        for q in (spectral, airtime):
+            if isinstance(q, EpochQueue):
+                q.queue.cancel_join_thread()  # the UI stops reading, do not wait for the queued records at exit
+        conn.close()
+
+
+class SensorWorker(object):
+    """
+    A sensor pipeline in a worker process. `factory` builds the pipeline in the worker, called as
+    factory(spectral=..., airtime=...) with the transports to deliver into (see SensorPipeline, FakePipeline).
+    The scanner methods are forwarded to the worker, current_chan, current_freq and current_ht_mode are
+    mirrored after every call.
+    """
+
+    def __init__(self, name, factory, transport="queue"):
+        self.name = name
+        if transport == "shm":
+            self.spectral, self.airtime = SpectralRingBuffer(), AirtimeRingBuffer()
+        else:
+            self.spectral, self.airtime = EpochQueue(), EpochQueue()
+        self.transport = transport
+        self.conn, child_conn = mp.Pipe()
+        # not a daemon, the pipeline starts processes of its own
+        self.process = mp.Process(target=_run_worker, name="sensor-" + name,
+                                  args=(factory, self.spectral, self.airtime, child_conn))
+        self.current_chan = self.current_freq = self.current_ht_mode = None
+        self.freqchan = []
+
+    def start(self):
+        self.process.start()
+        self.freqchan = [tuple(fc) for fc in self.call("get_supported_freqchan")]
+
+    def stop(self):
+        if self.process.is_alive():
+            self.conn.send(None)
+            self.process.join()
+        self.conn.close()
+        if self.transport == "shm":
+            self.spectral.close()
+            self.airtime.close()
+
+    def call(self, method, *args):
+        self.conn.send((method, args))
+        result, (self.current_chan, self.current_freq, self.current_ht_mode), error = self.conn.recv()
+        if error is not None:
+            raise error
+        return result
+
+
+class MultiScanner(object):
+    """
+    Stands in for the AthSpectralScanner of a single sensor: supports the channels of all sensors, mode,
+    HT mode and spectral count apply to all of them. set_channel() tunes the sensor that supports the
+    channel, which is then the one current_chan, current_freq and current_ht_mode refer to.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.focus = workers[0]
+
+    def worker_of(self, ch):
+        for worker in self.workers:
+            if ch in [chan for (freq, chan) in worker.freqchan]:
+                return worker
+        return None
+
+    def get_supported_freqchan(self):
+        return sorted(fc for worker in self.workers for fc in worker.freqchan)
+
+    def get_mode(self):
+        return self.focus.call("get_mode")
+
+    def get_spectral_count(self):
+        return self.focus.call("get_spectral_count")
+
+    def _call_all(self, method, *args):
+        for worker in self.workers:
+            worker.call(method, *args)
+
+    def set_mode(self, mode):
+        self._call_all("set_mode", mode)
+
+    def set_mode_background(self):
+        self._call_all("set_mode_background")
+
+    def set_mode_chanscan(self):
+        self._call_all("set_mode_chanscan")
+
+    def set_HT_mode(self, ht_mode):
+        self._call_all("set_HT_mode", ht_mode)
+
+    def set_spectral_count(self, count):
+        self._call_all("set_spectral_count", count)
+
+    def start(self):
+        self._call_all("start")
+
+    def set_channel(self, ch):
+        worker = self.worker_of(ch)
+        if worker is None:
+            logger.warning("no sensor supports channel %d" % ch)
+            return
+        worker.call("set_channel", ch)
+        self.focus = worker
+
+    @property
+    def current_chan(self):
+        return self.focus.current_chan
+
+    @property
+    def current_freq(self):
+        return self.focus.current_freq
+
+    @property
+    def current_ht_mode(self):
+        return self.focus.current_ht_mode
+
+
+class MultiSource(object):
+    """
+    Reads the sources of all sensors in turn, with the same interface as a single transport. The TSF clocks
+    of different radios are unrelated, so the TSF of every sensor is shifted onto the host clock at its first
+    record. `offsets` (host time - TSF per sensor, in us) is shared by the spectral and the airtime source of
+    the sensors, so the samples and frames of a radio stay aligned, whichever stream comes first.
+    The records are tagged with the index of their sensor ('sensor'), e.g. for the BurstDetector.
+    With `metrics` set, the records per sensor are counted as <kind>_<sensor name>.
+    """
+
+    def __init__(self, sources, names, kind, offsets, metrics=None):
+        self.sources = sources
+        self.names = names
+        self.kind = kind
+        self.metrics = metrics
+        self.offsets = offsets
+        self.epoch = 0
+
+    def read(self):
+        batches, offsets, sensors = [], [], []
+        empty = None
+        for i, source in enumerate(self.sources):
+            records = source.read()
+            if not len(records):
+                empty = records
+                continue
+            if self.offsets[i] is None:
+                self.offsets[i] = int(time.monotonic() * 1e6) - int(records['tsf'][0])
+            if self.metrics is not None:
+                self.metrics.count("%s_%s" % (self.kind, self.names[i]), len(records))
+            batches.append(records)
+            offsets.append(self.offsets[i])
+            sensors.append(i)
+        if not batches:
+            return empty
+        # copies, the views of a SharedRingBuffer are only valid until its next read()
+        records = np.concatenate(batches)
+        sizes = [len(batch) for batch in batches]
+        shift = np.repeat(np.array(offsets, dtype=np.int64), sizes)
+        records['tsf'] = (records['tsf'].astype(np.int64) + shift).astype(np.uint64)
+        records['sensor'] = np.repeat(np.array(sensors, dtype=np.uint8), sizes)
+        return records
+
+    def qsize(self):
+        return sum(source.qsize() for source in self.sources)
+
+    @property
+    def dropped(self):
+        return sum(source.dropped for source in self.sources)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        for source in self.sources:
+            source.set_epoch(epoch)
+
+    def clear(self):
+        for source in self.sources:
+            source.clear()
+
+
+class MultiSensor(object):
+    """
+    Several sensor pipelines, one worker process each, in place of a single SensorPipeline. `factories` maps
+    the name of a sensor (e.g. its interface) to the factory of its pipeline, see SensorWorker.
+    """
+
+    def __init__(self, factories, transport="queue"):
+        self.workers = [SensorWorker(name, factory, transport) for name, factory in factories.items()]
+        names = [worker.name for worker in self.workers]
+        if transport == "shm":
+            spectral = [worker.spectral for worker in self.workers]
+            airtime = [worker.airtime for worker in self.workers]
+        else:
+            spectral = [QueueReader(worker.spectral, pack_spectral) for worker in self.workers]
+            airtime = [QueueReader(worker.airtime, pack_airtime) for worker in self.workers]
+        self.offsets = [None] * len(self.workers)  # see MultiSource, set by the first record of a sensor
+        self.spectral = MultiSource(spectral, names, "ath", self.offsets)
+        self.airtime = MultiSource(airtime, names, "airtime", self.offsets)
+        self.scanner = MultiScanner(self.workers)
+
+    def set_metrics(self, metrics):
+        self.spectral.metrics = self.airtime.metrics = metrics
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
@@ -0,0 +1,556 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+"""
+Streams the decoded records of a sensor over the network, so the sensor can run on a headless AP and the
+UI on a workstation. The sensor side runs a Publisher, the UI reads from the sources of a Subscriber:
+
+    $ sudo python3 netstream.py wlan0 --target tcp:0.0.0.0:5555      (on the AP)
+    $ python3 ui.py --connect tcp:<ap>:5555                          (on the workstation)
+
+Every frame starts with a header (see frame_header), followed by the records in little-endian byte order.
+Spectral records only carry as many subcarriers as the widest record of the frame has (56 in HT20 instead of
+MAX_BINS), the payload can be zlib compressed. The first record of a frame is numbered per stream, so the
+subscriber can count the records lost on the way (UDP, or a publisher that dropped them for a slow client).
+With TCP the publisher listens and sends to every client, with UDP it sends to the given address, where the
+subscriber listens. The sensor info (see capture.sensor_info) goes to a TCP client first and is repeated
+every second via UDP.
+
+    $ python3 netstream.py --loopback 10 [--target udp:127.0.0.1:5555] [--compress]
+
+runs a synthetic sensor over loopback and reports the throughput and the lost records.
+"""
+
+import sys
+import json
+import time
+import zlib
+import queue
+import socket
+import struct
+import select
+import logging
+import argparse
+import threading
+import collections
+import numpy as np
+from transport import QueueReader, pack_spectral, pack_airtime, spectral_dtype, airtime_dtype, trimmed_dtype, \
+    trim_spectral, untrim_spectral
+from capture import ReplaySensor, sensor_info, kind_spectral, kind_airtime
+logger = logging.getLogger(__name__)
+
+MAGIC = b"ATHN"
+kind_info = 2  # payload: the sensor info as JSON
+flag_zlib = 1
+# magic, kind, flags, subcarriers per spectral record, number of the first record, records, payload length
+frame_header = struct.Struct("<4sBBHQII")
+max_payload = 60000  # uncompressed, so a frame fits into a UDP datagram
+
+
+def parse_target(target):
+    # tcp:<host>:<port> or udp:<host>:<port>
+    proto, host, port = target.split(":")
+    if proto not in ("tcp", "udp"):
+        raise ValueError("unknown protocol %s in %s" % (proto, target))
+    return proto, (host, int(port))
+
+
+def wire_dtype(kind, n_bins=0):
+    # layout of the records in a frame, spectral records cut to n_bins subcarriers
+    if kind == kind_airtime:
+        return airtime_dtype.newbyteorder("<")
+    return trimmed_dtype(n_bins).newbyteorder("<")
+
+
+def encode_frames(kind, records, seq, compress=False):
+    """
+    Returns the frames for the given records as (frame, records in it), split so that no payload exceeds
+    max_payload. `seq` is the number of the first record in its stream.
+    """
+    n_bins = 0
+    if kind == kind_spectral:
+        n_bins, wire = trim_spectral(records)
+        wire = wire.astype(wire_dtype(kind, n_bins))
+    else:
+        wire = records.astype(wire_dtype(kind))
+    per_frame = max(max_payload // wire.dtype.itemsize, 1)
+    frames = []
+    for start in range(0, len(wire), per_frame):
+        chunk = wire[start:start + per_frame]
+        payload = chunk.tobytes()
+        flags = 0
+        if compress:
+            payload = zlib.compress(payload, 1)
+            flags |= flag_zlib
+        frames.append((frame_header.pack(MAGIC, kind, flags, n_bins, seq + start, len(chunk), len(payload))
+                       + payload, len(chunk)))
+    return frames
+
+
+def encode_info(info):
+    payload = json.dumps(info).encode()
+    return frame_header.pack(MAGIC, kind_info, 0, 0, 0, 0, len(payload)) + payload
+
+
+def decode_payload(kind, flags, n_bins, count, payload):
+    # records of a frame, in the full layout of spectral_dtype / airtime_dtype
+    if flags & flag_zlib:
+        payload = zlib.decompress(payload)
+    wire = np.frombuffer(payload, dtype=wire_dtype(kind, n_bins), count=count)
+    if kind == kind_spectral:
+        return untrim_spectral(wire)
+    return wire.astype(airtime_dtype)
+
+
+def recv_exact(sock, n):
+    # None if the connection was closed before n bytes arrived
+    buf = bytearray()
+    while len(buf) < n:
+        data = sock.recv(n - len(buf))
+        if not data:
+            return None
+        buf += data
+    return bytes(buf)
+
+
+class PublisherClient(object):
+    """
+    A TCP client of the Publisher. The frames wait in a bounded queue for the sender thread, if the client
+    cannot keep up, new frames are dropped and counted, the sensor is never stalled by a slow client.
+    """
+
+    def __init__(self, sock, address, info, max_frames):
+        self.sock = sock
+        self.address = address
+        self.frames = queue.Queue(max_frames)
+        self.frames.put(encode_info(info))
+        self.dropped = 0  # records
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="publish-%s:%d" % address, daemon=True)
+        self.thread.start()
+
+    def put(self, frame, count):
+        try:
+            self.frames.put_nowait(frame)
+        except queue.Full:
+            self.dropped += count
+
+    def _run(self):
+        try:
+            while not self.closed:
+                frame = self.frames.get()
+                if frame is None:
+                    break
+                self.sock.sendall(frame)
+        except OSError as e:
+            logger.info("client %s:%d disconnected: %s" % (self.address + (e,)))
+        self.closed = True
+        self.sock.close()
+
+    def close(self):
+        self.closed = True
+        try:
+            self.frames.put_nowait(None)
+        except queue.Full:
+            pass
+        self.thread.join(1)
+
+
+class Publisher(object):
+    """
+    Reads the spectral and airtime sources of a sensor (anything with read(), see transport.py) and sends
+    the records to the subscribers. Records are collected for `batch_interval` seconds or up to `batch_size`
+    records per stream, then sent as frames.
+    """
+
+    def __init__(self, spectral, airtime, info, target, compress=False, batch_interval=0.02, batch_size=4096,
+                 max_frames=256):
+        self.sources = {kind_spectral: spectral, kind_airtime: airtime}
+        self.info = info
+        self.proto, self.address = parse_target(target)
+        self.compress = compress
+        self.batch_interval = batch_interval
+        self.batch_size = batch_size
+        self.max_frames = max_frames  # per TCP client
+        self.seq = {kind_spectral: 0, kind_airtime: 0}
+        self.pending = {kind_spectral: [], kind_airtime: []}
+        self.clients = []
+        self.clients_lock = threading.Lock()
+        self.dropped_gone = 0  # by clients that are gone
+        self.sent_bytes = 0
+        self.sent_records = 0
+        self.running = False
+        self.threads = []
+        if self.proto == "tcp":
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(self.address)
+            self.sock.listen(4)
+            self.sock.settimeout(0.5)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    @property
+    def dropped(self):
+        with self.clients_lock:
+            return self.dropped_gone + sum(client.dropped for client in self.clients)
+
+    def start(self):
+        self.running = True
+        targets = [(self._run, "publish")]
+        if self.proto == "tcp":
+            targets.append((self._accept, "publish-accept"))
+        for target, name in targets:
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        with self.clients_lock:
+            for client in self.clients:
+                client.close()
+            self.clients = []
+        self.sock.close()
+
+    def _accept(self):
+        while self.running:
+            try:
+                sock, address = self.sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            logger.info("client %s:%d connected" % address)
+            with self.clients_lock:
+                self.dropped_gone += sum(client.dropped for client in self.clients if client.closed)
+                self.clients = [client for client in self.clients if not client.closed]
+                self.clients.append(PublisherClient(sock, address, self.info, self.max_frames))
+
+    def _run(self):
+        last_flush = last_info = time.monotonic()
+        while self.running:
+            count = 0
+            for kind, source in self.sources.items():
+                records = source.read()
+                if len(records):
+                    self.pending[kind].append(records.copy())  # a view of a SharedRingBuffer does not last
+                    count += len(records)
+            now = time.monotonic()
+            if self.proto == "udp" and now - last_info >= 1.0:
+                self._send(encode_info(self.info), 0)
+                last_info = now
+            full = any(sum(len(r) for r in pending) >= self.batch_size for pending in self.pending.values())
+            if full or now - last_flush >= self.batch_interval:
+                self.flush()
+                last_flush = now
+            if not count:
+                time.sleep(self.batch_interval / 4)
+        self.flush()
+
+    def flush(self):
+        for kind, pending in self.pending.items():
+            if not pending:
+                continue
+            records = np.concatenate(pending)
+            pending.clear()
+            for frame, count in encode_frames(kind, records, self.seq[kind], self.compress):
+                self._send(frame, count)
+            self.seq[kind] += len(records)
+            self.sent_records += len(records)
+
+    def _send(self, frame, count):
+        self.sent_bytes += len(frame)
+        if self.proto == "udp":
+            try:
+                self.sock.sendto(frame, self.address)
+            except OSError as e:
+                logger.warning("sending to %s:%d failed: %s" % (self.address + (e,)))
+            return
+        with self.clients_lock:
+            for client in self.clients:
+                if not client.closed:
+                    client.put(frame, count)
+
+
+class NetSource(object):
+    """
+    The records of one stream received by a Subscriber, with the same interface as the transports in
+    transport.py. Holds up to `capacity` records, if the UI falls behind, new records are dropped and counted.
+    The records are tagged with the epoch of the UI side, as the sensor cannot be retuned from here.
+    """
+
+    def __init__(self, dtype, capacity):
+        self.empty_records = np.zeros(0, dtype=dtype)
+        self.capacity = capacity
+        self.batches = collections.deque()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.next_seq = None  # number of the next record expected from the publisher
+        self.overflow = 0  # records dropped here
+        self.lost = 0  # records that did not arrive
+        self.received = 0
+        self.epoch = 0
+
+    def push(self, records, seq):
+        with self.lock:
+            if self.next_seq is not None and seq > self.next_seq:
+                self.lost += seq - self.next_seq
+            self.next_seq = seq + len(records)
+            self.received += len(records)
+            if self.pending + len(records) > self.capacity:
+                self.overflow += len(records)
+                return
+            self.batches.append(records)
+            self.pending += len(records)
+
+    def reset(self):
+        # new connection, the numbering starts over
+        with self.lock:
+            self.next_seq = None
+
+    def read(self):
+        with self.lock:
+            batches = list(self.batches)
+            self.batches.clear()
+            self.pending = 0
+        if not batches:
+            return self.empty_records
+        records = np.concatenate(batches) if len(batches) > 1 else batches[0]
+        records['epoch'] = self.epoch
+        return records
+
+    def qsize(self):
+        return self.pending
+
+    @property
+    def dropped(self):
+        return self.overflow + self.lost
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.batches.clear()
+            self.pending = 0
+
+
+class RemoteSensor(ReplaySensor):
+    """
+    Stands in for the AthSpectralScanner of a remote sensor, set up from the info it sent. The sensor is
+    controlled on its own host, so all controls only log a note.
+    """
+
+    def _not_supported(self, *args):
+        logger.info("sensor controls are not available for a remote sensor")
+
+    set_mode_background = set_mode_chanscan = set_channel = set_spectral_count = set_HT_mode = _not_supported
+
+
+class Subscriber(object):
+    """
+    Receives the frames of a Publisher and delivers the records into its `spectral` and `airtime` sources,
+    which the UI reads like local transports. A TCP connection is reestablished if it breaks.
+    """
+
+    def __init__(self, target, capacity=65536):
+        self.proto, self.address = parse_target(target)
+        self.spectral = NetSource(spectral_dtype, capacity)
+        self.airtime = NetSource(airtime_dtype, capacity)
+        self.sources = {kind_spectral: self.spectral, kind_airtime: self.airtime}
+        self.info = None
+        self.info_event = threading.Event()
+        self.received_bytes = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        target = self._run_tcp if self.proto == "tcp" else self._run_udp
+        self.thread = threading.Thread(target=target, name="subscribe", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def wait_info(self, timeout=None):
+        # the sensor info, None if it did not arrive in time
+        self.info_event.wait(timeout)
+        return self.info
+
+    def sensor(self):
+        return RemoteSensor(self.info)
+
+    def handle(self, header, payload):
+        magic, kind, flags, n_bins, seq, count, length = header
+        self.received_bytes += frame_header.size + length
+        if kind == kind_info:
+            self.info = json.loads(payload.decode())
+            self.info_event.set()
+        elif kind in self.sources:
+            self.sources[kind].push(decode_payload(kind, flags, n_bins, count, payload), seq)
+        else:
+            logger.warning("frame of unknown kind %d" % kind)
+
+    def _run_tcp(self):
+        while self.running:
+            try:
+                sock = socket.create_connection(self.address, timeout=1.0)
+            except OSError:
+                time.sleep(1.0)
+                continue
+            logger.info("connected to %s:%d" % self.address)
+            for source in self.sources.values():
+                source.reset()
+            sock.settimeout(None)  # a frame is read as a whole, select() keeps an eye on self.running
+            try:
+                while self.running:
+                    if not select.select([sock], [], [], 0.5)[0]:
+                        continue
+                    data = recv_exact(sock, frame_header.size)
+                    if data is None:
+                        break
+                    header = frame_header.unpack(data)
+                    if header[0] != MAGIC:
+                        logger.warning("lost the frame sync, reconnecting")
+                        break
+                    payload = recv_exact(sock, header[6])
+                    if payload is None:
+                        break
+                    self.handle(header, payload)
+            except OSError as e:
+                logger.info("connection to %s:%d broke: %s" % (self.address + (e,)))
+            sock.close()
+
+    def _run_udp(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.bind(self.address)
+        sock.settimeout(0.5)
+        while self.running:
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                continue
+            if len(data) < frame_header.size:
+                continue
+            header = frame_header.unpack(data[:frame_header.size])
+            if header[0] != MAGIC or len(data) != frame_header.size + header[6]:
+                logger.warning("invalid datagram of %d bytes" % len(data))
+                continue
+            self.handle(header, data[frame_header.size:])
+        sock.close()
+
+
+def loopback(target, seconds, compress):
+    # a synthetic sensor through a publisher and a subscriber on this host
+    from fakesensor import FakeSensor, FakeAirtime
+    # all in this process, a mp.Queue would only leave a feeder thread behind that blocks the exit
+    ath_queue, airtime_queue = queue.Queue(), queue.Queue()
+    sensor = FakeSensor(ath_queue, seed=1)
+    airtime = FakeAirtime(sensor, airtime_queue, seed=2)
+    subscriber = Subscriber(target)
+    publisher = Publisher(QueueReader(ath_queue, pack_spectral), QueueReader(airtime_queue, pack_airtime),
+                          sensor_info(sensor), target, compress=compress)
+    subscriber.start()
+    publisher.start()
+    sensor.start()
+    airtime.start()
+    if subscriber.wait_info(5) is None:
+        logger.error("no sensor info from the publisher")
+    received = 0
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < seconds:
+        received += len(subscriber.spectral.read()) + len(subscriber.airtime.read())
+        time.sleep(0.01)
+    sensor.stop()
+    airtime.stop()
+    time.sleep(0.5)
+    publisher.stop()
+    received += len(subscriber.spectral.read()) + len(subscriber.airtime.read())
+    subscriber.stop()
+    duration = time.monotonic() - t0
+    print("sent      %10d records %12d bytes (%.0f bytes/record)" % (
+        publisher.sent_records, publisher.sent_bytes, publisher.sent_bytes / max(publisher.sent_records, 1)))
+    print("received  %10d records %12d bytes, %.0f records/s" % (received, subscriber.received_bytes,
+                                                                   received / duration))
+    print("lost      %10d records, dropped by the publisher: %d, by the subscriber: %d" % (
+        subscriber.spectral.lost + subscriber.airtime.lost, publisher.dropped,
+        subscriber.spectral.overflow + subscriber.airtime.overflow))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="stream the decoded samples of a sensor over the network")
+    parser.add_argument("interface", nargs="?", help="wifi interface of the sensor")
+    parser.add_argument("--target", default="tcp:0.0.0.0:5555",
+                        help="tcp:<host>:<port> to listen on or udp:<host>:<port> to send to "
+                             "(default: tcp:0.0.0.0:5555)")
+    parser.add_argument("--compress", action="store_true", help="zlib compress the frames")
+    parser.add_argument("--transport", choices=["queue", "shm"], default="queue",
+                        help="pass decoded samples via multiprocessing queues or shared memory ring buffers")
+    parser.add_argument("--min-decoders", type=int, default=1, metavar="N",
+                        help="decoder processes the sensor keeps running (default: 1)")
+    parser.add_argument("--max-decoders", type=int, default=None, metavar="N",
+                        help="decoder processes the sensor grows to under load (default: number of CPUs)")
+    parser.add_argument("--mode", choices=["background", "chanscan"], default="background",
+                        help="mode of the sensor (default: background)")
+    parser.add_argument("--channel", type=int, default=1, help="channel in background mode (default: 1)")
+    parser.add_argument("--loopback", type=float, metavar="SECONDS",
+                        help="stream a synthetic sensor to a subscriber on this host and report the throughput")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    if args.loopback:
+        target = args.target if not args.target.startswith("tcp:0.0.0.0") else "tcp:127.0.0.1:5555"
+        loopback(target, args.loopback, args.compress)
+        sys.exit()
+    if not args.interface:
+        parser.error("either an interface or --loopback is required")
+
+    from pipeline import SensorPipeline
+    pipeline = SensorPipeline(args.interface, args.transport, args.min_decoders, args.max_decoders)
+    sensor = pipeline.scanner
+    if args.mode == "chanscan":
+        sensor.set_mode("chanscan")
+    else:
+        sensor.set_channel(args.channel)
+    spectral, airtime = pipeline.spectral, pipeline.airtime
+    if not hasattr(spectral, "read"):
+        spectral, airtime = QueueReader(spectral, pack_spectral), QueueReader(airtime, pack_airtime)
+    publisher = Publisher(spectral, airtime, sensor_info(sensor), args.target, compress=args.compress)
+    pipeline.start()
+    publisher.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    publisher.stop()
+    pipeline.stop()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+
+import logging
+from transport import EpochQueue, SpectralRingBuffer, AirtimeRingBuffer
+from decoderpool import DecoderPool
+logger = logging.getLogger(__name__)
+
+_decoder = None  # per DecoderPool worker, see decode_raw()
+
+
+def decode_raw(chunk):
+    """
+    The decoding step of the live sensor, for a DecoderPool: turns a chunk of raw data as handed over by the
+    DataHub, (ts, data), into the items AthSpectralScanDecoder delivers, (ts, (tsf, freq_cf, noise, rssi, pwr)).
+    """
+    global _decoder
+    if _decoder is None:
+        from athspectralscan import AthSpectralScanDecoder
+        _decoder = AthSpectralScanDecoder()
+    ts, data = chunk
+    return [(ts, sample) for sample in _decoder._decode_data(data)]
+
+
+class SensorPipeline(object):
+    """
+    The live sensor: spectral scanner, decoder and airtime calculator on a wifi interface, delivering into
+    the spectral and airtime transports. The scanner starts in background mode on channel 1.
+    The transports can also be handed in, e.g. by a MultiSensor that runs the pipeline in a worker process.
+    The raw data is decoded by a DecoderPool of min_decoders .. max_decoders processes (None: the CPU count),
+    which keeps the TSF order of the samples.
+    """
+
+    def __init__(self, interface, transport="queue", min_decoders=1, max_decoders=None, spectral=None,
+                 airtime=None):
+        from athspectralscan import AthSpectralScanner, DataHub
+        from yanh.airtime import AirtimeCalculator
+
+        self.transport = transport
+        if spectral is not None:
+            self.spectral = spectral
+            self.airtime = airtime
+        elif transport == "shm":
+            self.spectral = SpectralRingBuffer()
+            self.airtime = AirtimeRingBuffer()
+        else:
+            self.spectral = EpochQueue()
+            self.airtime = EpochQueue()
+        self.scanner = AthSpectralScanner(interface=interface)
+        self.scanner.set_spectral_short_repeat(0)
+        self.scanner.set_mode("background")
+        self.scanner.set_channel(1)
+        self.airtimecalc = AirtimeCalculator(monitor_interface=interface, output_queue=self.airtime)
+        self.decoder = DecoderPool(decode_raw, self.spectral, min_workers=min_decoders, max_workers=max_decoders)
+        self.hub = DataHub(scanner=self.scanner, decoder=self.decoder)
+
+    def start(self):
+        self.decoder.start()
+        self.hub.start()
+        self.airtimecalc.start()
+        self.scanner.start()
+
+    def stop(self):
+        self.scanner.stop()
+        self.hub.stop()
+        self.decoder.stop()
+        self.airtimecalc.stop()
+        if self.transport == "shm":
+            self.spectral.close()
+            self.airtime.close()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import numpy as np
+
+SUBCARRIER_SPACING = 0.3125  # MHz, 20 MHz / 64 FFT bins
+
+
+def subcarrier_grid(centers):
+    # all frequencies a subcarrier can have on the given channels, HT20 and HT40 (either side) included
+    offsets = np.arange(-96, 96) * SUBCARRIER_SPACING
+    return np.unique(np.round(np.add.outer(np.asarray(centers, dtype=np.float64), offsets).ravel(), 4))
+
+
+class SpectrumHistogram(object):
+    """
+    Persistence plot for the chanscan/background views: a fixed grid of frequency bins x power bins
+    that counts how often a power level occurs on a subcarrier.
+    With freq_grid (see subcarrier_grid()), the samples only come at these frequencies. A bin that holds
+    more of them than its neighbours gets more counts, so render() divides by their number.
+    """
+
+    def __init__(self, freq_min, freq_max, power_min, power_max, freq_bins, power_res=0.5, freq_grid=None):
+        self.freq_min = freq_min
+        self.freq_max = freq_max
+        self.power_min = power_min
+        self.power_max = power_max
+        self.power_res = power_res
+        self.freq_bins = int(freq_bins)
+        self.power_bins = int(round((power_max - power_min) / power_res))
+        self.freq_scale = self.freq_bins / (freq_max - freq_min)
+        self.power_offset = int(round(power_min / power_res))
+        self.counts = np.zeros((self.freq_bins, self.power_bins), dtype=np.float32)
+        self.dirty = np.ones(self.freq_bins, dtype=bool)  # frequency bins changed since the last render_dirty()
+        self.fade_tsf = np.full(self.freq_bins, -1, dtype=np.int64)  # TSF of the last fade_columns() per bin
+        self.render_zmax = None
+        self.bin_weight = None  # 1 / frequencies of freq_grid per bin
+        if freq_grid is not None:
+            fi = self.freq_index(freq_grid)
+            density = np.bincount(fi[(fi >= 0) & (fi < self.freq_bins)], minlength=self.freq_bins)
+            self.bin_weight = (1.0 / np.maximum(density, 1)).astype(np.float32)
+
+    def clear(self):
+        self.counts.fill(0)
+        self.fade_tsf.fill(-1)
+        self.invalidate()
+
+    def invalidate(self):
+        # the next render_dirty() redraws everything
+        self.dirty.fill(True)
+
+    def decay(self, factor, floor=0.05):
+        # fade all counts, bins that fall below floor become empty (transparent) again
+        self.counts *= factor
+        self.counts[self.counts < floor] = 0
+        self.dirty.fill(True)
+
+    def fade_columns(self, freqs, tsf, window, floor=0.05):
+        """
+        Fades only the frequency bins of the given samples, by the TSF that passed since they were faded last
+        (1/e per window). Bins without new samples keep their counts, and stay clean for render_dirty().
+        """
+        fi = self.freq_index(freqs)
+        cols = np.flatnonzero(np.bincount(fi[(fi >= 0) & (fi < self.freq_bins)], minlength=self.freq_bins))
+        last = self.fade_tsf[cols]
+        elapsed = tsf - last
+        due = (last >= 0) & (elapsed >= window // 100)  # not worth touching the counts for less
+        if due.any():
+            faded = self.counts[cols[due]] * np.exp(-elapsed[due] / window)[:, None].astype(np.float32)
+            faded[faded < floor] = 0
+            self.counts[cols[due]] = faded
+            self.dirty[cols[due]] = True
+        self.fade_tsf[cols[(last < 0) | due]] = tsf
+
+    def freq_index(self, freqs):
+        return np.floor((np.asarray(freqs, dtype=np.float64) - self.freq_min) * self.freq_scale).astype(np.intp)
+
+    def add(self, freqs, powers):
+        # each bin holds the power levels in (p - power_res, p], same as math.ceil(sigval*2.0)/2.0
+        freqs = np.asarray(freqs, dtype=np.float64)
+        powers = np.asarray(powers, dtype=np.float64)
+        if not freqs.size:
+            return
+        fi = self.freq_index(freqs)
+        pi = np.ceil(powers / self.power_res).astype(np.intp) - self.power_offset - 1
+        ok = (powers > self.power_min) & (fi >= 0) & (fi < self.freq_bins) & (pi < self.power_bins)
+        idx = fi[ok] * self.power_bins + pi[ok]
+        self.counts += np.bincount(idx, minlength=self.counts.size).reshape(self.counts.shape)
+        self.dirty[fi[ok]] = True
+
+    def density(self):
+        # the counts per frequency of freq_grid
+        if self.bin_weight is None:
+            return self.counts
+        return self.counts * self.bin_weight[:, None]
+
+    def render(self, palette, size, zmax=None):
+        """
+        Map the counts to colors (relative to the busiest bin) and return a surface of the given size.
+        Empty bins are transparent, so the result can be blitted on top of the grid.
+        """
+        import pygame  # only needed for rendering, the dumper uses the histogram without a display
+        counts = self.density()
+        if zmax is None:
+            zmax = counts.max() or 1
+        color_idx = np.minimum(len(palette) * counts / zmax, len(palette) - 1).astype(np.intp)
+        rgb = np.take(palette, color_idx, axis=0)  # much faster than palette[color_idx]
+        rgb[counts == 0] = 0
+        # power axis grows upwards on screen
+        surface = pygame.surfarray.make_surface(rgb[:, ::-1])
+        surface.set_colorkey((0, 0, 0))
+        return pygame.transform.scale(surface, size)
+
+    def render_dirty(self, palette, size):
+        """
+        Like render(), but also returns the ranges of pixel columns (x0, x1) that changed since the last call,
+        so only those have to go to the screen. The color scale is kept until the busiest bin moved by more
+        than 1/8, then everything changed.
+        """
+        zmax = self.density().max() or 1
+        if self.render_zmax is None or abs(zmax - self.render_zmax) > self.render_zmax / 8:
+            self.render_zmax = zmax
+            self.dirty.fill(True)
+        cols = np.flatnonzero(self.dirty)
+        self.dirty.fill(False)
+        if not len(cols):
+            return None, []
+        gaps = np.flatnonzero(np.diff(cols) > 1)
+        starts = np.concatenate(([cols[0]], cols[gaps + 1]))
+        ends = np.concatenate((cols[gaps] + 1, [cols[-1] + 1]))
+        # pygame.transform.scale maps pixel column x to bin x * freq_bins // width
+        width = size[0]
+        ranges = [(-(-start * width // self.freq_bins), -(-end * width // self.freq_bins))
+                  for start, end in zip(starts, ends)]
+        return self.render(palette, size, self.render_zmax), [(x0, x1) for x0, x1 in ranges if x1 > x0]
+
+
+class SpectrumTraces(object):
+    """
+    Streaming aggregates per frequency bin over all samples: max-hold, mean (of the linear power) and
+    percentiles. The percentiles are read from a histogram of the power levels in full resolution.
+    """
+
+    def __init__(self, freq_min, freq_max, power_min, power_max, freq_bins, power_res=0.5):
+        self.dist = SpectrumHistogram(freq_min, freq_max, power_min, power_max, freq_bins, power_res)
+        self.max_hold = np.full(self.dist.freq_bins, -np.inf)
+        self.lin_sum = np.zeros(self.dist.freq_bins)
+        self.weight = np.zeros(self.dist.freq_bins)
+
+    def clear(self):
+        self.dist.clear()
+        self.max_hold.fill(-np.inf)
+        self.lin_sum.fill(0)
+        self.weight.fill(0)
+
+    def decay(self, factor):
+        # mean and percentiles follow the persistence of the plot, max-hold is kept until clear()
+        self.dist.decay(factor, floor=0)
+        self.lin_sum *= factor
+        self.weight *= factor
+
+    def add(self, freqs, powers):
+        freqs = np.asarray(freqs, dtype=np.float64)
+        powers = np.asarray(powers, dtype=np.float64)
+        if not freqs.size:
+            return
+        fi = self.dist.freq_index(freqs)
+        ok = (fi >= 0) & (fi < self.dist.freq_bins)
+        fi, pwr = fi[ok], powers[ok]
+        np.maximum.at(self.max_hold, fi, pwr)
+        self.lin_sum += np.bincount(fi, weights=10 ** (pwr / 10), minlength=self.dist.freq_bins)
+        self.weight += np.bincount(fi, minlength=self.dist.freq_bins)
+        self.dist.add(freqs, powers)
+
+    def mean(self):
+        # in dBm, NaN for bins without samples
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = 10 * np.log10(self.lin_sum / self.weight)
+        mean[self.weight == 0] = np.nan
+        return mean
+
+    def maximum(self):
+        return np.where(np.isfinite(self.max_hold), self.max_hold, np.nan)
+
+    def percentile(self, q):
+        # upper edge of the power bin that holds the q-th percentile, NaN for bins without samples
+        cum = np.cumsum(self.dist.counts, axis=1)
+        total = cum[:, -1]
+        idx = np.argmax(cum >= total[:, None] * (q / 100.0), axis=1)
+        pwr = self.dist.power_min + (idx + 1) * self.dist.power_res
+        return np.where(total > 0, pwr, np.nan)
+
+    def bin_freqs(self):
+        # center frequency of each bin
+        return self.dist.freq_min + (np.arange(self.dist.freq_bins) + 0.5) / self.dist.freq_scale
+
+
+class Reservoir(object):
+    """
+    Uniform random subset of at most `size` records out of all records added since the last take(),
+    by reservoir sampling (algorithm R, vectorized per batch).
+    """
+
+    def __init__(self, dtype, size, seed=None):
+        self.buf = np.zeros(size, dtype=dtype)
+        self.size = size
+        self.seen = 0
+        self.rng = np.random.default_rng(seed)
+
+    def add(self, records):
+        n = len(records)
+        fill = min(max(self.size - self.seen, 0), n)
+        self.buf[self.seen:self.seen + fill] = records[:fill]
+        rest = records[fill:]
+        if len(rest):
+            # the i-th record of the stream replaces a random slot with probability size / (i + 1)
+            pos = self.seen + fill + np.arange(len(rest))
+            slot = (self.rng.random(len(rest)) * (pos + 1)).astype(np.intp)
+            hit = slot < self.size
+            self.buf[slot[hit]] = rest[hit]  # on duplicate slots, the later record wins as in the sequential version
+        self.seen += n
+
+    def take(self):
+        """
+        Returns the sample (a view, valid until the next add()) and the number of records it was drawn from.
+        """
+        seen = self.seen
+        self.seen = 0
+        return self.buf[:min(seen, self.size)], seen
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import queue
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+MAX_BINS = 128  # HT40 delivers 128 subcarriers, HT20 56
+
+# one decoded FFT sample, pwr/freq hold n_bins valid subcarriers
+spectral_dtype = np.dtype([
+    ('tsf', np.uint64),
+    ('freq_cf', np.float32),
+    ('noise', np.float32),
+    ('rssi', np.float32),
+    ('n_bins', np.uint16),
+    ('freq', np.float32, (MAX_BINS,)),
+    ('pwr', np.float32, (MAX_BINS,)),
+    ('epoch', np.uint32),
+    ('chan_pwr', np.float32),  # power of the whole channel (dBm), computed by the producer, see channel_power()
+    ('sensor', np.uint8),  # index of the sensor in a MultiSensor, else 0
+])
+
+# one WiFi frame, also used for the merged power over time data of the heatmap (length -1: spectral)
+airtime_dtype = np.dtype([
+    ('tsf', np.uint64),
+    ('length', np.int32),
+    ('pwr', np.float32),
+    ('is_fcs_bad', np.bool_),
+    ('epoch', np.uint32),
+    ('sensor', np.uint8),  # as in spectral_dtype
+])
+
+
+def pack_spectral(items):
+    # items as delivered by AthSpectralScanDecoder: (ts, (tsf, freq_cf, noise, rssi, pwr_dict))
+    records = np.zeros(len(items), dtype=spectral_dtype)
+    if not items:
+        return records
+    tsf, freq_cf, noise, rssi, pwr = zip(*[data for (ts, data) in items])
+    records['tsf'] = tsf
+    records['freq_cf'] = freq_cf
+    records['noise'] = noise
+    records['rssi'] = rssi
+    n_bins = np.fromiter((min(len(p), MAX_BINS) for p in pwr), dtype=np.intp, count=len(pwr))
+    records['n_bins'] = n_bins
+    freqs = []
+    pwrs = []
+    for p, n in zip(pwr, n_bins):
+        freqs.extend(list(p.keys())[:n])
+        pwrs.extend(list(p.values())[:n])
+    rows = np.repeat(np.arange(len(items)), n_bins)
+    cols = np.arange(len(rows)) - np.repeat(np.cumsum(n_bins) - n_bins, n_bins)
+    records['freq'][rows, cols] = freqs
+    records['pwr'][rows, cols] = pwrs
+    records['chan_pwr'] = channel_power(records)
+    return records
+
+
+def pack_spectral_into(records, i, item, epoch=0):
+    # single item version of pack_spectral(), writes directly into records[i]
+    ts, (tsf, freq_cf, noise, rssi, pwr) = item
+    n = min(len(pwr), MAX_BINS)
+    records[i] = (tsf, freq_cf, noise, rssi, n, 0, 0, epoch, 0, 0)
+    records['freq'][i, :n] = np.fromiter(pwr.keys(), dtype=np.float32, count=n)
+    records['pwr'][i, :n] = np.fromiter(pwr.values(), dtype=np.float32, count=n)
+    # same as channel_power(), but only over the n subcarriers of this record
+    lin = (10 ** (records['pwr'][i, :n].astype(np.float64) / 10)).sum()
+    records['chan_pwr'][i] = 10 * np.log10(lin) if lin > 0 else -200.0
+
+
+def pack_airtime(items):
+    # items as delivered by AirtimeCalculator: (tsf, length, pwr, _, is_fcs_bad, _)
+    records = np.zeros(len(items), dtype=airtime_dtype)
+    if not items:
+        return records
+    tsf, length, pwr, _, is_fcs_bad, _ = zip(*items)
+    records['tsf'] = tsf
+    records['length'] = length
+    records['pwr'] = np.asarray(pwr, dtype=np.float64)  # pwr may come as string
+    records['is_fcs_bad'] = np.asarray(is_fcs_bad, dtype=bool)
+    return records
+
+
+def pack_airtime_into(records, i, item, epoch=0):
+    (tsf, length, pwr, _, is_fcs_bad, _) = item
+    records[i] = (tsf, length, float(pwr), bool(is_fcs_bad), epoch, 0)
+
+
+def trimmed_dtype(n_bins, dtype=spectral_dtype):
+    # dtype with the subcarrier fields cut to n_bins, to store or send records without the unused bins
+    return np.dtype([(name, dtype[name].base, (n_bins,)) if dtype[name].shape else (name, dtype[name])
+                     for name in dtype.names])
+
+
+def trim_spectral(records):
+    # copies the records into trimmed_dtype() of the largest n_bins among them, returns (n_bins, trimmed)
+    n_bins = max(int(records['n_bins'].max()), 1) if len(records) else 1
+    trimmed = np.zeros(len(records), dtype=trimmed_dtype(n_bins, records.dtype))
+    for name in trimmed.dtype.names:
+        trimmed[name] = records[name][:, :n_bins] if trimmed.dtype[name].shape else records[name]
+    return n_bins, trimmed
+
+
+def untrim_spectral(trimmed, dtype=spectral_dtype):
+    # the reverse of trim_spectral(), the bins past n_bins are zero
+    records = np.zeros(len(trimmed), dtype=dtype)
+    for name in trimmed.dtype.names:
+        if trimmed.dtype[name].shape:
+            records[name][:, :trimmed.dtype[name].shape[0]] = trimmed[name]
+        else:
+            records[name] = trimmed[name]
+    return records
+
+
+def spectral_power(records):
+    # flat (freq, pwr) arrays of all valid subcarriers of the given records
+    valid = np.arange(MAX_BINS) < records['n_bins'][:, None]
+    return records['freq'][valid], records['pwr'][valid]
+
+
+def channel_power(records):
+    # power of the whole channel per record in dBm, the sum over its subcarriers (see M.Rademacher).
+    # -200 if there is no power at all.
+    valid = np.arange(MAX_BINS) < records['n_bins'][:, None]
+    lin = np.where(valid, 10 ** (records['pwr'].astype(np.float64) / 10), 0).sum(axis=1)
+    with np.errstate(divide="ignore"):
+        return np.where(lin > 0, 10 * np.log10(lin), -200.0)
+
+
+def channel_snr(records):
+    # SNR of the whole channel per record in dB, -200 if there is no power at all
+    return np.where(records['chan_pwr'] > -200, records['chan_pwr'] - records['noise'], -200.0)
+
+
+class EpochQueue(object):
+    """
+    Producer side of the queue transport. Wraps a multiprocessing queue and tags every item with the
+    configuration epoch that is current when the producer puts it, so the UI can drop stale items.
+    """
+
+    def __init__(self):
+        self.queue = mp.Queue()
+        self.epoch = mp.Value("I", 0, lock=False)
+
+    def put(self, item, block=True, timeout=None):
+        self.queue.put((self.epoch.value, item), block, timeout)
+
+    def get(self, block=True, timeout=None):
+        return self.queue.get(block, timeout)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def empty(self):
+        return self.queue.empty()
+
+    def put_many(self, items):
+        for item in items:
+            self.put(item)
+
+    def set_epoch(self, epoch):
+        self.epoch.value = epoch
+
+
+class QueueReader(object):
+    """
+    Reads items from a (multiprocessing) queue and packs them into records, so the UI can handle
+    them the same way as batches from a SharedRingBuffer.
+    """
+
+    def __init__(self, q, pack, batch_size=4096):
+        self.queue = q
+        self.pack = pack
+        self.batch_size = batch_size
+        self.epoch = 0
+        self.stale = False  # set_epoch() on a plain queue: the reader drops what is queued on its next read()
+        self.dropped = 0  # a queue never drops
+
+    def read(self):
+        epoch = self.epoch  # before the stale check, see set_epoch()
+        if self.stale:
+            self.stale = False
+            self.clear()
+        items = []
+        while len(items) < self.batch_size:
+            try:
+                items.append(self.queue.get(block=False))
+            except queue.Empty:
+                break
+        if isinstance(self.queue, EpochQueue):
+            epochs = [epoch for (epoch, item) in items]
+            records = self.pack([item for (epoch, item) in items])
+            records['epoch'] = epochs
+            return records
+        records = self.pack(items)
+        records['epoch'] = epoch
+        return records
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def set_epoch(self, epoch):
+        if isinstance(self.queue, EpochQueue):
+            self.epoch = epoch
+            self.queue.set_epoch(epoch)
+        else:
+            # no way to tell old from new items, so the queue is drained. That is left to read(), the queue
+            # keeps a single reader. stale is set first: a read() that sees the new epoch also drains.
+            self.stale = True
+            self.epoch = epoch
+
+    def clear(self):
+        while True:
+            try:
+                self.queue.get(block=False)
+            except queue.Empty:
+                break
+
+
+class SharedRingBuffer(object):
+    """
+    Fixed-record ring buffer in shared memory. Producers (e.g. the decoder processes) use put() like
+    on a queue, or put_many() for a batch of items, the single consumer gets whole batches as zero-copy numpy
+    views from read(). If the buffer is full, new records are dropped and counted. Every record is tagged with
+    the configuration epoch that is current at put() time.
+    The items are packed before the lock is taken, so the producers only wait on each other for the copy.
+    """
+
+    (write_idx, read_idx, dropped_idx, epoch_idx) = range(4)
+    header_size = 64
+
+    def __init__(self, dtype, pack_into, pack, capacity):
+        self.dtype = np.dtype(dtype)
+        self.pack_into = pack_into
+        self.pack = pack
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(create=True, size=self.header_size + capacity * self.dtype.itemsize)
+        self.lock = mp.Lock()
+        self.owner = True
+        self._attach()
+        self.header[:] = 0
+
+    def _attach(self):
+        self.header = np.ndarray((4,), dtype=np.uint64, buffer=self.shm.buf)
+        self.records = np.ndarray((self.capacity,), dtype=self.dtype, buffer=self.shm.buf, offset=self.header_size)
+        self.pending = 0  # records handed out by the last read(), released on the next one
+
+    def __getstate__(self):
+        return self.dtype, self.pack_into, self.pack, self.capacity, self.shm.name, self.lock
+
+    def __setstate__(self, state):
+        self.dtype, self.pack_into, self.pack, self.capacity, name, self.lock = state
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = False
+        self._attach()
+
+    def put(self, item, block=True, timeout=None):
+        record = np.zeros(1, dtype=self.dtype)
+        self.pack_into(record, 0, item)
+        with self.lock:
+            w = int(self.header[SharedRingBuffer.write_idx])
+            if w - int(self.header[SharedRingBuffer.read_idx]) >= self.capacity:
+                self.header[SharedRingBuffer.dropped_idx] += 1
+                return
+            record['epoch'] = self.header[SharedRingBuffer.epoch_idx]
+            self.records[w % self.capacity] = record[0]
+            self.header[SharedRingBuffer.write_idx] = w + 1
+
+    def put_many(self, items):
+        # a batch of items, packed at once (e.g. the channel power is computed over the whole batch)
+        if items:
+            self._write(self.pack(items))
+
+    def _write(self, records):
+        with self.lock:
+            w = int(self.header[SharedRingBuffer.write_idx])
+            n = min(len(records), self.capacity - (w - int(self.header[SharedRingBuffer.read_idx])))
+            self.header[SharedRingBuffer.dropped_idx] += len(records) - n
+            if n <= 0:
+                return
+            records = records[:n]
+            records['epoch'] = int(self.header[SharedRingBuffer.epoch_idx])
+            start = w % self.capacity
+            first = min(n, self.capacity - start)
+            self.records[start:start + first] = records[:first]
+            self.records[:n - first] = records[first:]
+            self.header[SharedRingBuffer.write_idx] = w + n
+
+    def read(self):
+        """
+        Returns the next batch of records as view into the shared memory. The view stays valid until
+        the next call of read() or clear().
+        """
+        r = int(self.header[SharedRingBuffer.read_idx]) + self.pending
+        self.header[SharedRingBuffer.read_idx] = r
+        w = int(self.header[SharedRingBuffer.write_idx])
+        start = r % self.capacity
+        end = min(start + (w - r), self.capacity)  # do not wrap, the rest comes with the next read()
+        self.pending = end - start
+        return self.records[start:end]
+
+    def qsize(self):
+        return int(self.header[SharedRingBuffer.write_idx]) - int(self.header[SharedRingBuffer.read_idx])
+
+    def empty(self):
+        return self.qsize() == 0
+
+    @property
+    def dropped(self):
+        return int(self.header[SharedRingBuffer.dropped_idx])
+
+    @property
+    def epoch(self):
+        return int(self.header[SharedRingBuffer.epoch_idx])
+
+    def set_epoch(self, epoch):
+        self.header[SharedRingBuffer.epoch_idx] = epoch
+
+    def clear(self):
+        self.pending = 0
+        self.header[SharedRingBuffer.read_idx] = self.header[SharedRingBuffer.write_idx]
+
+    def close(self):
+        del self.header, self.records
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SpectralRingBuffer(SharedRingBuffer):
+
+    def __init__(self, capacity=16384):
+        super().__init__(spectral_dtype, pack_spectral_into, pack_spectral, capacity)
+
+
+class AirtimeRingBuffer(SharedRingBuffer):
+
+    def __init__(self, capacity=65536):
+        super().__init__(airtime_dtype, pack_airtime_into, pack_airtime, capacity)
@@ -21,12 +21,24 @@
 
 import sys
 import math
+import argparse
+import threading
+import time
+from functools import partial
 import pygame
 import logging
-import multiprocessing as mp
-import queue
-from athspectralscan import AthSpectralScanner, AthSpectralScanDecoder, DataHub
-from yanh.airtime import AirtimeCalculator
+import numpy as np
+from spectrum import SpectrumHistogram, SpectrumTraces, Reservoir, subcarrier_grid
+from waterfall import Waterfall, EventBuffer
+from merge import TsfMerger
+from history import History
+from transport import QueueReader, pack_spectral, pack_airtime, spectral_power, spectral_dtype, airtime_dtype
+from metrics import Metrics, MetricsExporter
+from pipeline import SensorPipeline
+from multisensor import MultiSensor
+from netstream import Subscriber
+from detector import BurstDetector, EventLog
+from capture import CaptureWriter, CaptureReader, CapturePlayer, ReplaySensor, sensor_info, kind_spectral, kind_airtime
 logger = logging.getLogger(__name__)
 logger.level = logging.DEBUG
 logger.addHandler(logging.StreamHandler(sys.stdout))
@@ -45,6 +57,8 @@ class SimpleUI(object):
         self.height = 600
         #self.width = 800
         self.tu_per_px = 225  # default: 115 for 8/2/16/0
+        self.tu_per_px_min = 7  # zoom range of the heatmap
+        self.tu_per_px_max = 225 * 2 ** 8
         #self.width = (100 * 1000) // (self.tu_per_px-3) -2 # try to align for beacons
         self.width = (1024 * 100) // self.tu_per_px   # try to align for beacons
         self.screen = pygame.display.set_mode((self.width, self.height))
@@ -54,33 +68,66 @@ class SimpleUI(object):
         self.screen.fill(self.bg_color)
 
         self.running = True
-        self.flush_data = False
         self.clean_screen = False
-
+        self.data_changed = False
+        self.lock = threading.Lock()  # guards the aggregated data between ingest thread and renderer
+        self.fps = 15  # target frame rate of the renderer
+        self.ingest_interval = 0.005  # s to wait if there are no new samples
+        self.metrics = Metrics()
+        self.show_metrics = False
+        self.tsf_newest = 0  # newest TSF taken from the sources
+        self.tsf_drawn = 0  # newest TSF on screen
+
+        self.grid_surface = None  # pre-rendered grid of the chanscan/background views
+        self.grid_key = None  # the geometry grid_surface was rendered for
+        self.fonts = {}  # font size: font
+        self.labels = {}  # (text, color, font size): rendered text
+        self.label_cache_size = 256
         self.color_map = self.gen_pallete()
+        self.palette = (np.array(self.color_map) * 255).astype(np.uint8)
 
-        self.freq_min = 2397.0  # FIXME: get from sensor
-        self.freq_max = 2482.0
         self.power_min = -130.0
         self.power_max = -20.0
-        self.grid_wide_freq = 5  # Mhz
+        self.grid_steps = (5, 10, 20, 40, 80, 160, 320)  # Mhz, the finest one with lines >= grid_min_px apart is used
+        self.grid_min_px = 20
         self.grid_wide_pwr = 10  # dBm
+        self.band_gap = 40  # Mhz, channels further apart than that get separate segments of the frequency axis
+        self.segment_gap = 10  # Mhz of axis between two segments
+        self.set_axis([(2397.0, 2482.0)])  # until set_sensor()
 
-        self.ath_queue_in = ath_queue_in
-        self.airtime_queue_in = airtime_queue_in
-
-        self.heatmap = {}
-        self.last_freq_cf = self.freq_max
-        self.curr_hmp = {}
-        self.save_tsf = 0
-        self.persistence_window = 1000000  # in TU, since we use the TSF field als timebase
-        self.bg_sample_count_limit = 100
-        self.bg_sample_count = 0
+        # a plain queue, a SharedRingBuffer or a ReplaySource will do
+        if hasattr(ath_queue_in, "read"):
+            self.ath_source = ath_queue_in
+        else:
+            self.ath_source = QueueReader(ath_queue_in, pack_spectral)
+        if hasattr(airtime_queue_in, "read"):
+            self.airtime_source = airtime_queue_in
+        else:
+            self.airtime_source = QueueReader(airtime_queue_in, pack_airtime)
+        self.dropped = 0
+        self.epoch = 0  # configuration epoch, see new_epoch()
+        self.recorder = None  # attach CaptureWriter here to dump the samples
+        self.detector = None  # attach BurstDetector here to log non-WiFi bursts
+
+        self.histogram = None
+        self.persistence_window = 1000000  # in TU, since we use the TSF field als timebase. Counts fade to 1/e within.
+        self.decay_tsf = None
+        self.bg_sample_count_limit = 100  # samples per frame in the dot cloud, the traces see all samples
+        self.reservoir = Reservoir(spectral_dtype, self.bg_sample_count_limit)
+        self.traces = None
+        self.show_traces = True
+        self.trace_percentiles = (50, 90)
+        self.trace_colors = {"max": (220, 60, 60), "mean": (230, 230, 80), 50: (200, 200, 200), 90: (230, 140, 40)}
 
         self.ui_update = True
 
-        self.pwr_time_data = []
-        self.tsf_start = 0
+        self.pwr_time_data = EventBuffer(airtime_dtype)  # bounded, so a stalled renderer cannot eat up the memory
+        self.reorder_window = 50000  # in TU, how long the heatmap waits for late samples of the other stream
+        self.merger = TsfMerger(airtime_dtype, streams=2, window=self.reorder_window)
+        self.waterfall = Waterfall(self.width, self.height, self.tu_per_px)
+        self.history = History(retention=300 * 1000000)
+        self.history_stat = "max"
+        self.view_tsf = None  # None: the heatmap follows the sensor, else TSF of the top left pixel of the paused view
         logger.debug("ui setup done")
 
         self.sensor = None  # attach sensor instance here
@@ -91,10 +138,21 @@ class SimpleUI(object):
 
     def set_sensor(self, sensor):
         self.sensor = sensor
-        self.freq_min, _ = min(sensor.get_supported_freqchan())
-        self.freq_min -= 10  # add lower 1/2 channel wide to viewport
-        self.freq_max, _ = max(sensor.get_supported_freqchan())
-        self.freq_max += 10  # add uper 1/2 channel wide to viewport
+        freqs = sorted(freq for (freq, chan) in sensor.get_supported_freqchan())
+        # 1/2 channel wide around the channels, one segment per run of neighbouring channels (e.g. per band)
+        segments = [[freqs[0] - 10, freqs[0] + 10]]
+        for freq in freqs[1:]:
+            if freq - 10 - segments[-1][1] > self.band_gap:
+                segments.append([freq - 10, freq + 10])
+            else:
+                segments[-1][1] = freq + 10
+        self.set_axis([tuple(segment) for segment in segments])
+        # histogram and traces are laid out along the axis, see freq_to_axis()
+        self.histogram = SpectrumHistogram(0, self.axis_len, self.power_min, self.power_max,
+                                           freq_bins=self.width // 2,
+                                           freq_grid=self.freq_to_axis(subcarrier_grid(freqs)))
+        self.traces = SpectrumTraces(
+            0, self.axis_len, self.power_min, self.power_max, freq_bins=self.width // 4)
         mode = sensor.get_mode()
         if mode == "chanscan":
             self.current_view = SimpleUI.view_cs
@@ -106,7 +164,11 @@ class SimpleUI(object):
         self.update_caption()
 
     def main_loop(self):
-        FPS = 15
+        ingest_thread = threading.Thread(target=self.ingest_loop, name="ingest", daemon=True)
+        ingest_thread.start()
+        frame_budget = 1000.0 / self.fps  # ms
+        dropped_frames = 0
+        last_report = time.monotonic()
         while self.running:
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
@@ -114,39 +176,97 @@ class SimpleUI(object):
                 if event.type == pygame.KEYDOWN:
                     self.handle_keypress(event.key)
 
-            if self.flush_data:
-                self.flush_data = False
-                self.flush()
-                self.screen.fill(self.bg_color)
-                if self.current_view is SimpleUI.view_cs or self.current_view is SimpleUI.view_bg:
-                    self.draw_grid()
-
-            pygame.display.update()
-            self.update_data()  # does the heavy math 1/2
-
-            if self.clean_screen:
-                self.clean_screen = False
-                self.heatmap = {}
-                self.screen.fill(self.bg_color)
-                if self.current_view is SimpleUI.view_cs or self.current_view is SimpleUI.view_bg:
-                    self.draw_grid()
-
-            if self.current_view is SimpleUI.view_cs or self.current_view is SimpleUI.view_bg:
-                self.data_to_screen_freq()    # does the heavy math 2/2
-            elif self.current_view is SimpleUI.view_hm:
-                self.data_to_screen_power()  # does the heavy math 2/2
-
-            if not self.ui_update:
-                self.draw_centered_text(
-                    "(UI Update Disabled)", self.width/2, self.height/2, (200, 200, 200), font_size=40)
-
-                #self.clock.tick(FPS)
-
+            with self.lock:
+                full_update = False
+                if self.clean_screen:
+                    self.clean_screen = False
+                    self.data_changed = True
+                    full_update = True
+                    self.screen.fill(self.bg_color)
+                    if self.current_view is SimpleUI.view_cs or self.current_view is SimpleUI.view_bg:
+                        self.draw_grid()
+                        self.histogram.invalidate()
+
+                if self.data_changed:  # skip the frame if there is nothing new
+                    self.data_changed = False
+                    rects = None
+                    if self.show_metrics and self.current_view is SimpleUI.view_cs:
+                        self.histogram.invalidate()  # the overlay is blended over the plot, redraw it from scratch
+                    with self.metrics.timed("draw"):
+                        if self.current_view is SimpleUI.view_cs or self.current_view is SimpleUI.view_bg:
+                            rects = self.data_to_screen_freq()    # does the heavy math 2/2
+                        elif self.current_view is SimpleUI.view_hm:
+                            self.data_to_screen_power()  # does the heavy math 2/2
+                    self.tsf_drawn = self.tsf_newest
+
+                    if not self.ui_update:
+                        self.draw_centered_text(
+                            "(UI Update Disabled)", self.width/2, self.height/2, (200, 200, 200), font_size=40)
+                        full_update = True
+                    if self.show_metrics:
+                        self.draw_metrics()
+                        full_update = True
+                    with self.metrics.timed("display"):
+                        if full_update or rects is None:
+                            pygame.display.update()
+                        elif rects:
+                            pygame.display.update(rects)
+                    self.metrics.count("frames")
+
+            elapsed = self.clock.tick(self.fps)
+            if elapsed > 1.5 * frame_budget:
+                dropped_frames += int(elapsed // frame_budget) - 1
+                self.metrics.count("frames_dropped", int(elapsed // frame_budget) - 1)
+            if time.monotonic() - last_report > 5 and dropped_frames:
+                logger.info("render loop dropped %d frames in %.0fs (%.1f of %d fps)" % (
+                    dropped_frames, time.monotonic() - last_report, self.clock.get_fps(), self.fps))
+                dropped_frames = 0
+                last_report = time.monotonic()
+            self.update_metrics()
 
         # not running anymore
+        ingest_thread.join()
         pygame.event.post(pygame.event.Event(pygame.QUIT))
         pygame.quit()
 
+    def ingest_loop(self):
+        # runs in its own thread, takes the samples from the sources and aggregates them for the renderer
+        while self.running:
+            try:
+                if not self.update_data():  # does the heavy math 1/2
+                    time.sleep(self.ingest_interval)
+            except Exception:
+                # keep the display going, the next batch may be fine again
+                logger.exception("ingest of the samples failed")
+                time.sleep(self.ingest_interval)
+
+    def update_metrics(self):
+        m = self.metrics
+        for name, source in (("ath", self.ath_source), ("airtime", self.airtime_source)):
+            try:
+                m.gauge("qlen_" + name, source.qsize())
+            except NotImplementedError:  # mp.Queue.qsize() on macOS
+                pass
+        m.gauge("transport_dropped", self.dropped)
+        m.gauge("hm_pending", self.merger.pending())
+        if self.detector is not None:
+            m.gauge("bursts", len(self.detector.log))
+        m.gauge("tsf_lag_us", int(self.tsf_newest - self.tsf_drawn))
+        m.gauge("loop_fps", round(self.clock.get_fps(), 1))
+        if m.tick() and self.show_metrics:
+            self.data_changed = True  # show the new values
+
+    def draw_metrics(self):
+        font = self.get_font(18)
+        lines = ["%s: %s" % (k, v) for (k, v) in sorted(self.metrics.last.items()) if k != "time"]
+        line_height = font.get_linesize()
+        box = pygame.Surface((220, line_height * len(lines) + 8))
+        box.set_alpha(200)
+        box.fill((20, 20, 20))
+        self.screen.blit(box, (4, 4))
+        for i, line in enumerate(lines):
+            self.screen.blit(font.render(line, 1, (200, 200, 200)), (8, 8 + i * line_height))
+
     def quit(self, *args):
         self.running = False
 
@@ -159,54 +279,40 @@ class SimpleUI(object):
         # Switch UI
         elif key == pygame.K_b:
             self.current_view = SimpleUI.view_bg
-            self.flush_data = True
-            self.update_caption()
-            if self.sensor.get_mode() == "background":
-                return
-            self.sensor.set_mode_background()
-            self.sensor.start()
+            if self.sensor.get_mode() != "background":
+                self.sensor.set_mode_background()
+                self.sensor.start()
+            self.new_epoch()
         elif key == pygame.K_c:
             self.current_view = SimpleUI.view_cs
-            self.flush_data = True
-            self.update_caption()
-            if self.sensor.get_mode() == "chanscan":
-                return
-            self.sensor.set_mode_chanscan()
-            self.sensor.start()
+            if self.sensor.get_mode() != "chanscan":
+                self.sensor.set_mode_chanscan()
+                self.sensor.start()
+            self.new_epoch()
         elif key == pygame.K_h:
             self.current_view = SimpleUI.view_hm
-            self.flush_data = True
-            self.update_caption()
-            if self.sensor.get_mode() == "background":
-                return
-            self.sensor.set_mode_background()
-            self.sensor.start()
+            if self.sensor.get_mode() != "background":
+                self.sensor.set_mode_background()
+                self.sensor.start()
+            self.new_epoch()
 
         # Tune (if possible)
-        elif key == pygame.K_LEFT:
-            if self.sensor.get_mode() == "chanscan":
-                return
-            self.flush_data = True
-            ch = self.sensor.current_chan - 1
-            if ch < min([chan for (freq, chan) in self.sensor.get_supported_freqchan()]):
-                ch = max([chan for (freq, chan) in self.sensor.get_supported_freqchan()])
-            self.sensor.set_channel(ch)
-        elif key == pygame.K_RIGHT:
+        elif key == pygame.K_LEFT or key == pygame.K_RIGHT:
             if self.sensor.get_mode() == "chanscan":
                 return
-            self.flush_data = True
-            ch = self.sensor.current_chan + 1
-            if ch > max([chan for (freq, chan) in self.sensor.get_supported_freqchan()]):
-                ch = min([chan for (freq, chan) in self.sensor.get_supported_freqchan()])
-            self.sensor.set_channel(ch)
+            # step through the supported channels, they are not contiguous in 5 GHz or across bands
+            chans = [chan for (freq, chan) in sorted(self.sensor.get_supported_freqchan())]
+            idx = chans.index(self.sensor.current_chan) if self.sensor.current_chan in chans else 0
+            idx += -1 if key == pygame.K_LEFT else 1
+            self.sensor.set_channel(chans[idx % len(chans)])
+            self.new_epoch()
 
         # Increase sample count or persistence
         elif key == pygame.K_UP:
             if self.sensor.get_mode() == "background":
                 self.bg_sample_count_limit += 10
-                self.bg_sample_count = 0
-                self.flush_data = True
-                logger.info("set bg persistence cnt to %d" % self.bg_sample_count_limit)
+                self.flush()
+                logger.info("set bg sample count to %d per frame" % self.bg_sample_count_limit)
             else:
                 sample_count = self.sensor.get_spectral_count() * 2
                 if sample_count == 256:  # special case, 256 is not valid, set to last valid value
@@ -214,15 +320,14 @@ class SimpleUI(object):
                 if sample_count > 255:
                     sample_count = 1
                 self.sensor.set_spectral_count(sample_count)
-                self.update_caption()
+                self.new_epoch()
         elif key == pygame.K_DOWN:
             if self.sensor.get_mode() == "background":
                 self.bg_sample_count_limit -= 10
                 if self.bg_sample_count_limit < 0:
                     self.bg_sample_count_limit = 0
-                self.bg_sample_count = 0
-                self.flush_data = True
-                logger.info("set bg persistence cnt to %d" % self.bg_sample_count_limit)
+                self.flush()
+                logger.info("set bg sample count to %d per frame" % self.bg_sample_count_limit)
             else:
                 sample_count = self.sensor.get_spectral_count()
                 if sample_count == 255:
@@ -231,15 +336,57 @@ class SimpleUI(object):
                 if sample_count < 1:
                     sample_count = 255
                 self.sensor.set_spectral_count(sample_count)
-                self.update_caption()
+                self.new_epoch()
         # Toggle HT20/HT40 mode
         elif key == pygame.K_m:
-            self.flush_data = True
             logger.info("Toggle HT mode from %s " % self.sensor.current_ht_mode)
             if self.sensor.current_ht_mode == "HT20":
                 self.sensor.set_HT_mode("HT40")
             else:
                 self.sensor.set_HT_mode("HT20")
+            self.new_epoch()
+
+        # Toggle performance overlay
+        elif key == pygame.K_i:
+            self.show_metrics = not self.show_metrics
+            self.clean_screen = True
+
+        # Zoom and scroll the heatmap
+        elif key in (pygame.K_PLUS, pygame.K_EQUALS, pygame.K_KP_PLUS, pygame.K_MINUS, pygame.K_KP_MINUS):
+            if self.current_view is not SimpleUI.view_hm:
+                return
+            zoom_in = key not in (pygame.K_MINUS, pygame.K_KP_MINUS)
+            tu_per_px = self.tu_per_px // 2 if zoom_in else self.tu_per_px * 2
+            if not self.tu_per_px_min <= tu_per_px <= self.tu_per_px_max:
+                return
+            if self.view_tsf is not None:  # keep the center of the paused view
+                screen_tu = self.width * self.height
+                self.view_tsf += screen_tu * (self.tu_per_px - tu_per_px) // 2
+                self.view_tsf = max(self.view_tsf, self.history.oldest())
+            self.tu_per_px = tu_per_px
+            self.show_history()
+        elif key in (pygame.K_PAGEUP, pygame.K_PAGEDOWN, pygame.K_END, pygame.K_a):
+            if self.current_view is not SimpleUI.view_hm or self.history.tsf_newest is None:
+                return
+            half_screen_tu = self.width * (self.height // 2) * self.tu_per_px
+            if key == pygame.K_a:
+                self.history_stat = "mean" if self.history_stat == "max" else "max"
+            elif key == pygame.K_END:
+                self.view_tsf = None
+            elif key == pygame.K_PAGEUP:
+                if self.view_tsf is None:
+                    self.view_tsf = int(self.waterfall.tsf_start)
+                self.view_tsf = max(self.view_tsf - half_screen_tu, self.history.oldest())
+            elif self.view_tsf is not None:
+                self.view_tsf += half_screen_tu
+                if self.view_tsf + 2 * half_screen_tu > self.history.tsf_newest:  # back at the present
+                    self.view_tsf = None
+            self.show_history()
+
+        # Toggle traces of the background view
+        elif key == pygame.K_t:
+            self.show_traces = not self.show_traces
+            self.clean_screen = True
 
         # ignore unknown key
         else:
@@ -257,44 +404,54 @@ class SimpleUI(object):
         caption += " "+self.sensor.current_ht_mode+""
         if self.current_view == SimpleUI.view_hm:
             caption += " %d us/px" % self.tu_per_px
-        #if self.sensor.dumping:
-        #    caption += " [dumping to file]"
+            if self.view_tsf is not None and self.history.tsf_newest is not None:
+                caption += " [history -%.1fs, %s]" % ((self.history.tsf_newest - self.view_tsf) / 1e6,
+                                                       self.history_stat)
+        if self.recorder is not None:
+            caption += " [dumping to file]"
         pygame.display.set_caption(caption)
 
-    @staticmethod
-    def tsf_to_px(tsf_start, tsf, wx, wy, tu_per_px):
-        tsf = tsf - tsf_start  # shift to origin
-        tsf /= tu_per_px  # scale down (up?)
-        (y, x) = divmod(tsf, wx)
-        return int(x), int(y)
-
-    @staticmethod
-    def px_to_tsf(px, wx, tu_per_px):
-        return px * tu_per_px * wx
-
-    @staticmethod
-    def frame_len_to_px(length, tu_per_px):
-        px, _ = divmod(length, tu_per_px)
-        return int(px)
-
-    @staticmethod
-    def pwr_to_color(pwr):
-        dbm_min = -180
-        dbm_max = -10
-        # map 0-255 to dbm_max - min:
-        if dbm_min < pwr < dbm_max:
-            return int(((pwr - dbm_min) / (dbm_max - dbm_min)) * 255)
-        return 0
+    def new_epoch(self):
+        # the sensor setup changed, everything delivered so far is stale. The sources tag new samples
+        # with the new epoch and the stale ones are dropped as they arrive, so there is nothing to drain.
+        with self.metrics.timed("flush"):
+            self.epoch += 1
+            logger.debug("new epoch %d, qlen ath: %d, qlen air: %d" % (
+                self.epoch, self.ath_source.qsize(), self.airtime_source.qsize()))
+            self.ath_source.set_epoch(self.epoch)
+            self.airtime_source.set_epoch(self.epoch)
+            if self.detector is not None:
+                with self.lock:  # the ingest thread feeds it under the lock, after the epoch check
+                    self.detector.flush()  # the bursts so far belong to the old setup
+            self.flush()
 
     def flush(self):
-        logger.debug("flush() qlen ath: %d" % self.ath_queue_in.qsize())
-        while not self.ath_queue_in.empty():
-            self.ath_queue_in.get()
-        logger.debug("flush() qlen air: %d" % self.airtime_queue_in.qsize())
-        while not self.airtime_queue_in.empty():
-            self.airtime_queue_in.get()
-        self.tsf_start = 0
-        self.heatmap = {}
+        with self.lock:
+            self.pwr_time_data.clear()
+            self.merger.clear()
+            self.history.clear()
+            self.view_tsf = None
+            self.waterfall.clear()
+            self.histogram.clear()
+            self.traces.clear()
+            self.reservoir = Reservoir(spectral_dtype, self.bg_sample_count_limit)
+            self.decay_tsf = None
+            self.clean_screen = True
+
+    def show_history(self):
+        # re-render the heatmap from the history, either the paused view or the recent past up to the middle
+        # of the screen, from where it goes on live
+        with self.lock:
+            self.waterfall = Waterfall(self.width, self.height, self.tu_per_px)
+            self.clean_screen = True
+            if self.history.tsf_newest is None:
+                return
+            tsf_start = self.view_tsf
+            if tsf_start is None:
+                tsf_start = self.history.tsf_newest - self.width * (self.height // 2) * self.tu_per_px
+                tsf_start = max(tsf_start, self.history.oldest())
+            colors = self.history.render(tsf_start, self.width * self.height, self.tu_per_px, self.history_stat)
+            self.waterfall.load(tsf_start, colors)
 
     def gen_pallete(self):
         # create a 256-color gradient from blue->green->white
@@ -318,11 +475,32 @@ class SimpleUI(object):
                              mid_col[2] * sf + end_col[2] * sf2)
         return colors
 
+    def set_axis(self, segments):
+        """
+        Lays out the frequency axis: the (freq_min, freq_max) segments side by side, segment_gap apart, so
+        e.g. the 2.4 and the 5 GHz band share the screen without the empty GHz between them.
+        """
+        self.segments = segments
+        widths = np.array([hi - lo for (lo, hi) in segments], dtype=np.float64)
+        starts = np.concatenate(([0], np.cumsum(widths + self.segment_gap)[:-1]))
+        self.axis_freqs = np.array(segments, dtype=np.float64).ravel()
+        self.axis_pos = np.column_stack((starts, starts + widths)).ravel()
+        self.axis_len = float(self.axis_pos[-1])
+        steps = [step for step in self.grid_steps if step * self.width >= self.grid_min_px * self.axis_len]
+        self.grid_wide_freq = steps[0] if steps else self.grid_steps[-1]
+
+    def freq_to_axis(self, freqs):
+        # position on the frequency axis in Mhz from its left end, off the axis for frequencies outside of it
+        return np.interp(freqs, self.axis_freqs, self.axis_pos, left=-1.0, right=self.axis_len + 1)
+
+    def axis_to_freq(self, pos):
+        return np.interp(pos, self.axis_pos, self.axis_freqs)
+
     def sample_to_viewport(self, freq, power, wx, wy):
 
         # normalize both frequency and power to [0,1] interval, and
         # then scale by window size
-        freq_normalized = (freq - self.freq_min) / (self.freq_max - self.freq_min)
+        freq_normalized = self.freq_to_axis(freq) / self.axis_len
         freq_scaled = freq_normalized * wx
 
         power_normalized = (power - self.power_min) / (self.power_max - self.power_min)
@@ -333,181 +511,329 @@ class SimpleUI(object):
 
         return freq_scaled, power_scaled
 
-    def draw_centered_text(self, text, x, y, color, font_size=20):
-        #font = pygame.font.SysFont("monospace", 20)
-        font = pygame.font.Font(None, font_size)
-        label = font.render(text, 1, color)
-        sx, sy = font.size(text)
-        self.screen.blit(label, (x - sx/2, y - sy/2))
-
-    def draw_grid(self):
-        # horizontal lines (frequency)
-        for freq in range(int(self.freq_min), int(self.freq_max), self.grid_wide_freq):
-            start_xy = self.sample_to_viewport(freq, self.power_min, self.width, self.height)
-            end_xy = self.sample_to_viewport(freq, self.power_max, self.width, self.height)
-            pygame.draw.line(self.screen, self.line_color, start_xy, end_xy)
-            if freq != self.freq_min and freq != self.freq_max:
-                self.draw_centered_text("%d" % freq, start_xy[0], 20, self.text_color)
+    def get_font(self, font_size):
+        if font_size not in self.fonts:
+            self.fonts[font_size] = pygame.font.Font(None, font_size)
+        return self.fonts[font_size]
+
+    def render_label(self, text, color, font_size=20):
+        # the labels hardly ever change, so render each one only once
+        key = (text, color, font_size)
+        label = self.labels.get(key)
+        if label is None:
+            if len(self.labels) >= self.label_cache_size:
+                self.labels.clear()
+            label = self.labels[key] = self.get_font(font_size).render(text, 1, color)
+        return label
+
+    def draw_centered_text(self, text, x, y, color, font_size=20, surface=None):
+        label = self.render_label(text, tuple(color), font_size)
+        sx, sy = label.get_size()
+        (surface or self.screen).blit(label, (x - sx/2, y - sy/2))
+
+    def grid_layer(self):
+        # the grid is rendered once per geometry
+        key = (tuple(self.segments), self.power_min, self.power_max, self.width, self.height,
+               self.grid_wide_freq, self.grid_wide_pwr)
+        if key != self.grid_key:
+            self.grid_surface = self.render_grid()
+            self.grid_key = key
+        return self.grid_surface
+
+    def draw_grid(self, rect=None):
+        # the whole grid, or only the given area of it
+        if rect is None:
+            self.screen.blit(self.grid_layer(), (0, 0))
+        else:
+            self.screen.blit(self.grid_layer(), rect, rect)
+
+    def render_grid(self):
+        surface = pygame.Surface((self.width, self.height))
+        surface.fill(self.bg_color)
+        # horizontal lines (frequency), per segment of the axis, through the first channel of the segment
+        step = self.grid_wide_freq
+        label_end = 0  # right end of the last label, labels that would overlap it are left out
+        for i, (freq_min, freq_max) in enumerate(self.segments):
+            x0 = self.axis_pos[2 * i] / self.axis_len * self.width
+            if i:  # fill the gap to the previous segment
+                x1 = self.axis_pos[2 * i - 1] / self.axis_len * self.width
+                pygame.draw.rect(surface, self.line_color, (x1, 0, max(x0 - x1, 1), self.height))
+            label_end = max(label_end, x0)
+            first = int(freq_min) + 10
+            for freq in range(first - (first - int(freq_min)) // step * step, int(freq_max), step):
+                start_xy = self.sample_to_viewport(freq, self.power_min, self.width, self.height)
+                end_xy = self.sample_to_viewport(freq, self.power_max, self.width, self.height)
+                pygame.draw.line(surface, self.line_color, start_xy, end_xy)
+                half = self.render_label("%d" % freq, self.text_color).get_width() / 2 + 2
+                if freq != freq_min and start_xy[0] - half >= label_end:
+                    self.draw_centered_text("%d" % freq, start_xy[0], 20, self.text_color, surface=surface)
+                    label_end = start_xy[0] + half
 
         # vertical lines (power)
         for power in range(int(self.power_min), int(self.power_max), self.grid_wide_pwr):
-            start_xy = self.sample_to_viewport(self.freq_min, power, self.width, self.height)
-            end_xy = self.sample_to_viewport(self.freq_max, power, self.width, self.height)
-            pygame.draw.line(self.screen, self.line_color, start_xy, end_xy)
+            start_xy = self.sample_to_viewport(self.segments[0][0], power, self.width, self.height)
+            end_xy = self.sample_to_viewport(self.segments[-1][1], power, self.width, self.height)
+            pygame.draw.line(surface, self.line_color, start_xy, end_xy)
             if power != self.power_min and power != self.power_max:
-                self.draw_centered_text("%d dBm" % power, 35, start_xy[1], self.text_color)
+                self.draw_centered_text("%d dBm" % power, 35, start_xy[1], self.text_color, surface=surface)
+        return surface
 
     def update_data(self):
-        self.bg_sample_count = 0
-        hmp = self.heatmap
+        """
+        Takes all pending samples from the sources and aggregates them for the current view.
+        Returns the number of records read.
+        """
+        count = 0
         while True:
-            try:
-                (ts, data) = self.ath_queue_in.get(block=False)
-            except queue.Empty:
+            with self.metrics.timed("read"):
+                records = self.ath_source.read()
+            if not len(records):
                 break
-
-            if self.current_view is SimpleUI.view_cs or self.current_view is SimpleUI.view_bg:
-                (tsf, freq_cf, noise, rssi, pwr) = data
-                if self.current_view is SimpleUI.view_cs:
-                    if freq_cf < self.last_freq_cf:
-                        self.clean_screen = True
-                    self.last_freq_cf = freq_cf
-                elif self.current_view is SimpleUI.view_bg:
-                    if tsf > self.save_tsf + self.persistence_window:
-                        self.save_tsf = tsf + self.persistence_window
-                        self.clean_screen = True
-                    if self.bg_sample_count == self.bg_sample_count_limit:
-                        continue
-                    self.bg_sample_count += 1
-                else:
+            count += len(records)
+            self.metrics.count("spectral_samples", len(records))
+            epoch = self.ath_source.epoch
+            records = self.current_records(records, epoch)
+            if not len(records):
+                continue
+            self.tsf_newest = max(self.tsf_newest, int(records['tsf'].max()))
+            if self.recorder is not None:
+                self.recorder.write(kind_spectral, records)
+            with self.lock:
+                if epoch != self.ath_source.epoch:  # retuned in the meantime
                     continue
-                for freq_sc, sigval in pwr.items():
-                    if sigval <= self.power_min:  # skip invisible pixel
-                        continue
-                    if freq_sc not in hmp.keys():
-                        hmp[freq_sc] = {}
-                    arr = hmp[freq_sc]
-                    mody = math.ceil(sigval*2.0)/2.0
-                    arr.setdefault(mody, 0)  # pwr level is unknown
-                    arr[mody] += 1.0  # count how often, a pwr level occurs per freq_sc
-            elif self.current_view is SimpleUI.view_hm:
-                (tsf, freq_cf, noise, rssi, pwr) = data
-                pwr_channel = self.pwr_of_channel(pwr)
-                self.pwr_time_data.append((tsf, -1, pwr_channel, None))
+                if self.detector is not None:  # behind the check, new_epoch() flushes it under the lock
+                    with self.metrics.timed("detect"):
+                        self.detector.add_spectral(records)
+                with self.metrics.timed("aggregate"):
+                    self.data_changed = True
+                    view = self.current_view  # the key handler may switch it any time outside the lock
+                    if view is SimpleUI.view_cs:
+                        self.add_chanscan(records)
+                    elif view is SimpleUI.view_bg:
+                        self.add_background(records)
+                    elif view is SimpleUI.view_hm:
+                        events = np.zeros(len(records), dtype=airtime_dtype)
+                        events['tsf'] = records['tsf']
+                        events['length'] = -1
+                        events['pwr'] = records['chan_pwr']  # computed by the producer
+                        self.add_heatmap(0, events)
 
         while True:
-            try:
-                data = self.airtime_queue_in.get(block=False)
-            except queue.Empty:
+            with self.metrics.timed("read"):
+                records = self.airtime_source.read()
+            if not len(records):
                 break
-            if self.current_view is SimpleUI.view_hm:
-                (tsf, length, pwr, _, is_fcs_bad, _) = data
-                self.pwr_time_data.append((tsf, length, pwr, is_fcs_bad))
-        self.heatmap = hmp
-
-    def pwr_of_channel(self, pwr_per_subcarrier):
-        # see M.Rademacher
-        rssi_sum = 0
-        for freq, pwr in pwr_per_subcarrier.items():
-            rssi_sum += 10 ** (pwr / 10)
-        if rssi_sum != 0:
-            rssi_channel = 10 * math.log10(rssi_sum)
-            return rssi_channel
-        else:
-            return -200   # fixme: better idea?
+            count += len(records)
+            self.metrics.count("airtime_frames", len(records))
+            epoch = self.airtime_source.epoch
+            records = self.current_records(records, epoch)
+            if not len(records):
+                continue
+            self.tsf_newest = max(self.tsf_newest, int(records['tsf'].max()))
+            if self.recorder is not None:
+                self.recorder.write(kind_airtime, records)
+            with self.lock:
+                if epoch != self.airtime_source.epoch:  # retuned in the meantime
+                    continue
+                if self.detector is not None:
+                    with self.metrics.timed("detect"):
+                        self.detector.add_airtime(records)
+                if self.current_view is SimpleUI.view_hm:
+                    with self.metrics.timed("aggregate"):
+                        self.data_changed = True
+                        self.add_heatmap(1, records)
+
+        dropped = self.ath_source.dropped + self.airtime_source.dropped
+        if dropped > self.dropped:
+            logger.warning("transport overflow, %d records dropped (%d total)" % (dropped - self.dropped, dropped))
+            self.dropped = dropped
+        return count
+
+    def current_records(self, records, epoch):
+        # drop the records of an older sensor setup
+        if 'epoch' not in records.dtype.names:  # e.g. older captures
+            return records
+        current = records['epoch'] >= epoch
+        if current.all():
+            return records
+        self.metrics.count("stale_discarded", len(records) - np.count_nonzero(current))
+        return records[current]
+
+    def add_chanscan(self, records):
+        freqs, powers = spectral_power(records)
+        freqs = self.freq_to_axis(freqs)
+        # only the channels of the sweep that got new samples fade, the others stay clean for the renderer
+        self.histogram.fade_columns(freqs, int(records['tsf'].max()), self.persistence_window)
+        self.histogram.add(freqs, powers)
+
+    def add_background(self, records):
+        self.decay_persistence(int(records['tsf'].max()))
+        # all samples go into the traces, the dot cloud only shows a random subset of them per frame
+        freqs, powers = spectral_power(records)
+        self.traces.add(self.freq_to_axis(freqs), powers)
+        self.reservoir.add(records)
+
+    def add_heatmap(self, stream, events):
+        # spectral samples (stream 0) and frames (stream 1) go through the merger, so the waterfall sees
+        # them in TSF order no matter in which order the sources deliver
+        late = self.merger.push(stream, events)
+        if late:
+            self.metrics.count("hm_late", late)
+        events = self.merger.pop()
+        if not len(events):
+            return
+        self.history.add(events)
+        overwritten = self.pwr_time_data.append(events)
+        if overwritten:
+            self.metrics.count("hm_overwritten", overwritten)
+
+    def decay_persistence(self, tsf):
+        # fade out the histogram by the TSF that passed since the last call, instead of wiping it periodically
+        if self.decay_tsf is None or tsf < self.decay_tsf:  # first samples or TSF reset
+            self.decay_tsf = tsf
+            return
+        elapsed = tsf - self.decay_tsf
+        if elapsed < self.persistence_window // 100:  # not worth touching the histogram yet
+            return
+        factor = math.exp(-elapsed / self.persistence_window)
+        self.histogram.decay(factor)
+        self.traces.decay(factor)
+        self.decay_tsf = tsf
 
     def data_to_screen_freq(self):
-        zmax = 0
-        for center_freq in self.heatmap.keys():
-            last_pwr = -float('inf')
-            for power, value in self.heatmap[center_freq].items():
-                if power > last_pwr:
-                    last_pwr = power
-                if zmax < value:
-                    zmax = self.heatmap[center_freq][power]
-
-        if not zmax:
-            zmax = 1
-
-        for center_freq in self.heatmap.keys():
-            for power, value in self.heatmap[center_freq].items():
-                posx, posy = self.sample_to_viewport(center_freq, power, self.width, self.height)
-                color = self.color_map[int(len(self.color_map) * value / zmax) & 0xff]
-                c = (color[0]*255, color[1]*255, color[2]*255)
-                pygame.draw.rect(self.screen, c, (posx, posy, 2, 2))
+        """
+        Returns the list of screen areas that changed, or None if all of it did.
+        """
+        if self.current_view is SimpleUI.view_cs:
+            # redraw only the channels that got new samples, on top of the cached grid
+            surface, ranges = self.histogram.render_dirty(self.palette, (self.width, self.height))
+            rects = [pygame.Rect(x0, 0, x1 - x0, self.height) for (x0, x1) in ranges]
+            for rect in rects:
+                self.draw_grid(rect)
+                self.screen.blit(surface, rect, rect)
+            return rects
+        sample, seen = self.reservoir.take()
+        freqs, powers = spectral_power(sample)
+        self.histogram.add(self.freq_to_axis(freqs), powers)
+        if seen > len(sample):
+            self.metrics.count("bg_discarded", seen - len(sample))
+        # bins fade out, so the plot cannot just be drawn over the last frame
+        self.draw_grid()
+        self.screen.blit(self.histogram.render(self.palette, (self.width, self.height)), (0, 0))
+        if self.show_traces:
+            self.draw_traces()
+        return None
+
+    def draw_traces(self):
+        traces = [("max", self.traces.maximum()), ("mean", self.traces.mean())]
+        traces += [(q, self.traces.percentile(q)) for q in self.trace_percentiles]
+        freqs = self.axis_to_freq(self.traces.bin_freqs())
+        x = 80
+        for name, trace in traces:
+            color = self.trace_colors[name]
+            xs, ys = self.sample_to_viewport(freqs, np.clip(trace, self.power_min, self.power_max),
+                                             self.width, self.height)
+            # one polyline per run of bins with samples
+            valid = np.concatenate(([False], ~np.isnan(trace), [False]))
+            edges = np.flatnonzero(valid[1:] != valid[:-1]).reshape(-1, 2)
+            for start, end in edges:
+                if end - start > 1:
+                    pygame.draw.lines(self.screen, color, False, list(zip(xs[start:end], ys[start:end])))
+            label = name if isinstance(name, str) else "p%d" % name
+            self.draw_centered_text(label, x, self.height - 15, color)
+            x += 40
 
     def data_to_screen_power(self):
-        max_y = 0
-        for (tsf, length, pwr, is_fcs_bad) in self.pwr_time_data:
-            if self.tsf_start == 0:  # first sample
-                self.tsf_start = tsf
-
-            x, y = self.tsf_to_px(self.tsf_start, tsf, self.width, self.height, self.tu_per_px)
-            max_y = y
-            if length == -1:  # spectral sample. set single pixel
-                intensity = self.pwr_to_color(pwr)
-                #print "sample:", x,y, intensity
-                c = (0, intensity, 0)
-                #print(((x, y), c), pwr)
-                #pygame.draw.rect(self.screen, c, (x, y, 2, 2))
-                self.screen.set_at((x, y), c)
-                #pygame.display.update()
-
-            else:
-                intensity = self.pwr_to_color(float(pwr))
-                if is_fcs_bad:
-                    c = (intensity, 0, 0) # Red
-                else:
-                    c = (0, 0, intensity)  # Blue
-                if float(pwr) == -2.0:
-                    c = (255, 0, 0)
-                    logger.warn("pwr less wifi sample detected")
-
-                px = self.frame_len_to_px(length, self.tu_per_px)
-                #print "frame: ", x,y, pwr, intensity, px
-                i = 0
-                while px > i:
-                    if x + i >= self.width:
-                        y2, x2 = divmod(x+i, self.width)
-                        self.screen.set_at((x2, y+y2), c)
-                        if max_y < y+y2:
-                            max_y = y+y2
-                            #pygame.draw.rect(self.screen, c, (x2, y+y2, 2, 2))
-                    else:
-                        self.screen.set_at((x+i, y), c)
-                        #pygame.draw.rect(self.screen, c, (x+i, y, 2, 2))
-                    i += 1
-        if max_y >= self.height-10:  # 10 margin ?
-            y_px_to_scroll = - self.height / 10
-            tsf_scroll = self.px_to_tsf(y_px_to_scroll, self.width, self.tu_per_px)
-            self.tsf_start -= tsf_scroll
-            # print "scroll", tsf - self.tsf_start, tsf_scroll
-            self.screen.scroll(0, int(y_px_to_scroll))
-            pygame.draw.rect(self.screen, self.bg_color, (0, self.height+y_px_to_scroll, self.width, self.height))
-
-        self.pwr_time_data = []
+        if len(self.pwr_time_data):
+            events = self.pwr_time_data.take()
+            if self.view_tsf is None:  # a paused view keeps its picture, the events are in the history anyway
+                self.waterfall.draw(events['tsf'], events['length'], events['pwr'], events['is_fcs_bad'])
+        self.waterfall.blit(self.screen)
 
 if __name__ == '__main__':
-    athss_queue = mp.Queue()
-    airtime_queue = mp.Queue()
-    scanner = AthSpectralScanner(interface=sys.argv[1])
-    scanner.set_spectral_short_repeat(0)
-    scanner.set_mode("background")
-    scanner.set_channel(1)
-    airtimecalc = AirtimeCalculator(monitor_interface=sys.argv[1], output_queue=airtime_queue)
-    decoder = AthSpectralScanDecoder()
-    decoder.set_number_of_processes(1)
-    decoder.set_output_queue(athss_queue)
-    hub = DataHub(scanner=scanner, decoder=decoder)
-
-    decoder.start()
-    hub.start()
-    airtimecalc.start()
-    scanner.start()
-
-    ui = SimpleUI(athscanner=scanner, ath_queue_in=athss_queue, airtime_queue_in=airtime_queue)
+    parser = argparse.ArgumentParser(description="ISM spectrum visualizer based on the ath9k spectral scan")
+    parser.add_argument("interface", nargs="*",
+                        help="wifi interface of the sensor, several ones (e.g. 2.4 and 5 GHz) are shown side by side")
+    parser.add_argument("--transport", choices=["queue", "shm"], default="queue",
+                        help="pass decoded samples via multiprocessing queues or shared memory ring buffers")
+    parser.add_argument("--record", metavar="FILE", help="dump the decoded samples to a capture file")
+    parser.add_argument("--replay", metavar="FILE", help="replay a capture file instead of using a sensor")
+    parser.add_argument("--events", metavar="FILE", help="detect non-WiFi bursts and append them to an event log")
+    parser.add_argument("--connect", metavar="TARGET",
+                        help="show a remote sensor streamed by netstream.py, tcp:<host>:<port> or udp:<host>:<port>")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed as multiple of real time, 0 means as fast as possible (default: 1)")
+    parser.add_argument("--seek", type=float, default=0.0, metavar="SECONDS",
+                        help="start the replay SECONDS after the begin of the capture")
+    parser.add_argument("--history", type=float, default=300, metavar="SECONDS",
+                        help="how far the heatmap can scroll back (default: 300)")
+    parser.add_argument("--min-decoders", type=int, default=1, metavar="N",
+                        help="decoder processes the sensor keeps running (default: 1)")
+    parser.add_argument("--max-decoders", type=int, default=None, metavar="N",
+                        help="decoder processes the sensor grows to under load (default: number of CPUs)")
+    parser.add_argument("--fps", type=int, default=15, help="target frame rate of the UI (default: 15)")
+    parser.add_argument("--metrics", metavar="TARGET",
+                        help="periodically write performance metrics as JSON to a file or to udp:<host>:<port>")
+    parser.add_argument("--metrics-interval", type=float, default=1.0, metavar="SECONDS",
+                        help="export interval of the metrics (default: 1)")
+    args = parser.parse_args()
+    if not args.interface and not args.replay and not args.connect:
+        parser.error("either an interface, --replay or --connect is required")
+
+    if args.replay:
+        reader = CaptureReader(args.replay)
+        player = CapturePlayer(reader, speed=args.speed)
+        player.seek(reader.tsf_first + int(args.seek * 1e6))
+        ui = SimpleUI(athscanner=ReplaySensor(reader.sensor), ath_queue_in=player.spectral,
+                      airtime_queue_in=player.airtime)
+        ui.caption_prefix += " (Replay)"
+    elif args.connect:
+        subscriber = Subscriber(args.connect)
+        subscriber.start()
+        if subscriber.wait_info(timeout=10) is None:
+            subscriber.stop()
+            parser.error("no sensor info from %s" % args.connect)
+        ui = SimpleUI(athscanner=subscriber.sensor(), ath_queue_in=subscriber.spectral,
+                      airtime_queue_in=subscriber.airtime)
+        ui.caption_prefix += " (%s)" % args.connect
+    elif len(args.interface) > 1:
+        pipeline = MultiSensor({interface: partial(SensorPipeline, interface, min_decoders=args.min_decoders,
+                                                   max_decoders=args.max_decoders)
+                                for interface in args.interface}, args.transport)
+        pipeline.start()
+        ui = SimpleUI(athscanner=pipeline.scanner, ath_queue_in=pipeline.spectral,
+                      airtime_queue_in=pipeline.airtime)
+        pipeline.set_metrics(ui.metrics)
+    else:
+        pipeline = SensorPipeline(args.interface[0], args.transport, args.min_decoders, args.max_decoders)
+        pipeline.start()
+        ui = SimpleUI(athscanner=pipeline.scanner, ath_queue_in=pipeline.spectral,
+                      airtime_queue_in=pipeline.airtime)
+
+    ui.fps = args.fps
+    ui.history = History(retention=int(args.history * 1e6))
+    if args.record:
+        ui.recorder = CaptureWriter(args.record, sensor_info(ui.sensor))
+    if args.events:
+        ui.detector = BurstDetector(EventLog(args.events))
+    ui.update_caption()
+    exporter = None
+    if args.metrics:
+        exporter = MetricsExporter(ui.metrics, args.metrics, interval=args.metrics_interval)
+        exporter.start()
+
     ui.main_loop()  # UI takes care of events, blocking
 
-    scanner.stop()
-    hub.stop()
-    airtimecalc.stop()
+    if exporter is not None:
+        exporter.stop()
+    if ui.recorder is not None:
+        ui.recorder.close()
+    if ui.detector is not None:
+        ui.detector.flush()
+        ui.detector.log.close()
+    if args.replay:
+        reader.close()
+    elif args.connect:
+        subscriber.stop()
+    else:
+        pipeline.stop()
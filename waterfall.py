@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   This file is part of the athgui project.
+#
+#   Copyright (C) 2017 Robert Felten - https://github.com/rfelten/
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import numpy as np
+import pygame
+logger = logging.getLogger(__name__)
+
+
+def pwr_to_intensity(pwr):
+    # map dbm_min..dbm_max to 0-255, everything outside is black
+    dbm_min = -180
+    dbm_max = -10
+    pwr = np.asarray(pwr, dtype=np.float64)
+    intensity = ((pwr - dbm_min) / (dbm_max - dbm_min)) * 255
+    return np.where((dbm_min < pwr) & (pwr < dbm_max), intensity, 0).astype(np.uint8)
+
+
+class Waterfall(object):
+    """
+    Framebuffer of the heatmap view. Time runs left to right and then top to bottom, so a pixel row
+    holds width * tu_per_px TU. Spectral samples (length -1) set a single pixel, WiFi frames a span
+    of pixels that wraps into the next row.
+    """
+
+    def __init__(self, width, height, tu_per_px):
+        self.width = width
+        self.height = height
+        self.tu_per_px = tu_per_px
+        self.tsf_start = 0
+        # row major, so a frame that wraps into the next row is a contiguous range of the flat buffer
+        self.fb = np.zeros((height, width, 3), dtype=np.uint8)
+        self.pixels = self.fb.reshape(-1, 3)
+
+    def clear(self):
+        self.tsf_start = 0
+        self.fb.fill(0)
+
+    def tsf_to_px(self, tsf):
+        # returns the position as index into the flat framebuffer
+        rel = (np.asarray(tsf, dtype=np.float64) - self.tsf_start) / self.tu_per_px
+        y = np.floor_divide(rel, self.width)
+        x = rel - y * self.width
+        return y.astype(np.int64) * self.width + x.astype(np.int64)
+
+    def px_to_tsf(self, px):
+        return px * self.tu_per_px * self.width
+
+    def frame_len_to_px(self, length):
+        return np.floor_divide(np.asarray(length, dtype=np.float64), self.tu_per_px).astype(np.int64)
+
+    def draw(self, tsf, length, pwr, is_fcs_bad):
+        if not len(tsf):
+            return
+        tsf = np.asarray(tsf)
+        length = np.asarray(length)
+        pwr = np.asarray(pwr, dtype=np.float64)
+        is_fcs_bad = np.asarray(is_fcs_bad, dtype=bool)
+        if self.tsf_start == 0:  # first sample
+            self.tsf_start = tsf[0]
+
+        pos = self.tsf_to_px(tsf)
+        is_spectral = length == -1
+        intensity = pwr_to_intensity(pwr)
+        colors = np.zeros((len(tsf), 3), dtype=np.uint8)
+        colors[is_spectral, 1] = intensity[is_spectral]  # Green
+        is_frame = ~is_spectral
+        colors[is_frame & is_fcs_bad, 0] = intensity[is_frame & is_fcs_bad]  # Red
+        colors[is_frame & ~is_fcs_bad, 2] = intensity[is_frame & ~is_fcs_bad]  # Blue
+        pwr_less = is_frame & (pwr == -2.0)
+        if pwr_less.any():
+            colors[pwr_less] = (255, 0, 0)
+            logger.warning("%d pwr less wifi samples detected" % np.count_nonzero(pwr_less))
+
+        # number of pixels per sample, expand every sample to its pixel range
+        npx = np.where(is_spectral, 1, self.frame_len_to_px(np.maximum(length, 0)))
+        first = np.cumsum(npx) - npx
+        idx = np.repeat(pos - first, npx) + np.arange(npx.sum())
+        valid = (idx >= 0) & (idx < self.pixels.shape[0])
+        self.pixels[idx[valid]] = np.repeat(colors, npx, axis=0)[valid]
+
+        last_y = (pos[-1] + max(npx[-1] - 1, 0)) // self.width
+        if last_y >= self.height - 10:  # 10 margin ?
+            self.scroll()
+
+    def scroll(self):
+        y_px_to_scroll = self.height // 10
+        self.tsf_start += self.px_to_tsf(y_px_to_scroll)
+        self.fb[:] = np.roll(self.fb, -y_px_to_scroll, axis=0)
+        self.fb[-y_px_to_scroll:] = 0
+
+    def load(self, tsf_start, colors):
+        # replace the whole picture, e.g. rendered from the history
+        self.tsf_start = tsf_start
+        self.pixels[:] = colors
+
+    def blit(self, surface):
+        pygame.surfarray.blit_array(surface, self.fb.transpose(1, 0, 2))
+
+
+class EventBuffer(object):
+    """
+    Bounded FIFO for the heatmap events between ingest and drawing. If drawing falls behind, the oldest
+    events are overwritten, they would have scrolled out of the waterfall anyway.
+    """
+
+    def __init__(self, dtype, capacity=65536):
+        self.buf = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, records):
+        """
+        Appends the records, returns the number of events that were overwritten to make room.
+        """
+        n = len(records)
+        overwritten = max(self.count + n - self.capacity, 0)
+        if n > self.capacity:
+            records = records[n - self.capacity:]
+            n = self.capacity
+        drop = min(overwritten, self.count)
+        self.start = (self.start + drop) % self.capacity
+        self.count -= drop
+        end = (self.start + self.count) % self.capacity
+        first = min(n, self.capacity - end)
+        self.buf[end:end + first] = records[:first]
+        self.buf[:n - first] = records[first:]
+        self.count += n
+        return overwritten
+
+    def take(self):
+        """
+        Returns all events in order of arrival and empties the buffer.
+        """
+        end = self.start + self.count
+        if end <= self.capacity:
+            events = self.buf[self.start:end].copy()
+        else:
+            events = np.concatenate((self.buf[self.start:], self.buf[:end - self.capacity]))
+        self.clear()
+        return events
+
+    def clear(self):
+        self.start = 0
+        self.count = 0